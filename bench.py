@@ -0,0 +1,301 @@
+"""
+Track transition benchmark.
+
+Drives `MusicPlayer` through natural track ends, skips, playlist switches and
+rapid skip bursts against a fake omxplayer that only sleeps for its spawn and
+exit costs, then reports how long each kind of transition took to produce
+sound from the next file. Runs anywhere, no Pi, D-Bus or audio needed:
+
+    python3 bench.py --transitions 2000 --spawn-ms 800 -o bench_output.txt
+"""
+import os
+import sys
+import time
+import types
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+
+# the music module imports these at the top, a dev machine may not have them
+for name in ("evdev", "omxplayer", "dbus"):
+    try:
+        __import__(name)
+    except ImportError:
+        placeholder = types.ModuleType(name)
+        if name == "evdev":
+            for attr in ("eventio", "uinput", "InputEvent", "InputDevice", "categorize", "ecodes"):
+                setattr(placeholder, attr, None)
+        else:
+            placeholder.OMXPlayer = None
+        sys.modules[name] = placeholder
+
+from modules.music import MusicPlayer
+
+
+class Recorder:
+    """Times the gap between a transition being triggered and the next player making sound"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = None
+        self.sounded = threading.Event()
+        self.latencies = {}
+
+    def mark(self, kind) -> None:
+        with self.lock:
+            self.started = (kind, time.perf_counter())
+            self.sounded.clear()
+
+    def sound(self) -> None:
+        with self.lock:
+            if self.started:
+                kind, started = self.started
+                if kind:
+                    self.latencies.setdefault(kind, []).append(time.perf_counter() - started)
+                self.started = None
+                self.sounded.set()
+
+    def wait(self, timeout) -> bool:
+        return self.sounded.wait(timeout)
+
+
+class FakePlayer:
+    """
+    Stands in for `omxplayer.OMXPlayer`. Starting costs `spawn` seconds like the real
+    process and D-Bus handshake, quitting costs `exit` seconds before `exitEvent` fires,
+    and a track ends by itself after `length` seconds of playback.
+    """
+    spawn = 0.04
+    exit = 0.005
+    length = 0.1
+    recorder = None
+    onEnd = None  # called right before a track ends by itself
+
+    def __init__(self, source, args=None, dbus_name=None, pause=False):
+        time.sleep(self.spawn)
+        self.source = source
+        self.dbusName = dbus_name
+        self.exitEvent = lambda player, status: None
+        self.lock = threading.Lock()
+        self.status = "Paused"
+        self.played = 0.0  # seconds played before the last resume
+        self.resumed = None
+        self.done = False
+        self.timer = None
+        if not pause:
+            self.play()
+
+    # playback clock
+
+    def position(self) -> float:
+        with self.lock:
+            if self.resumed is None:
+                return self.played
+            return self.played + time.monotonic() - self.resumed
+
+    def duration(self) -> float:
+        return self.length
+
+    def get_source(self) -> str:
+        return self.source
+
+    def playback_status(self) -> str:
+        return self.status
+
+    def is_playing(self) -> bool:
+        return self.status == "Playing"
+
+    # commands
+
+    def play(self) -> None:
+        with self.lock:
+            if self.done or self.status == "Playing":
+                return
+            self.status = "Playing"
+            self.resumed = time.monotonic()
+            remaining = max(self.length - self.played, 0)
+        self.timer = threading.Timer(remaining, self.end)
+        self.timer.daemon = True
+        self.timer.start()
+        if self.recorder:
+            self.recorder.sound()
+
+    def pause(self) -> None:
+        with self.lock:
+            if self.status != "Playing":
+                return
+            self.played += time.monotonic() - self.resumed
+            self.resumed = None
+            self.status = "Paused"
+        if self.timer:
+            self.timer.cancel()
+
+    def set_position(self, position) -> None:
+        with self.lock:
+            self.played = position
+            if self.resumed is not None:
+                self.resumed = time.monotonic()
+
+    def set_volume(self, volume) -> None:
+        pass
+
+    def play_pause(self) -> None:
+        if self.status == "Playing":
+            self.pause()
+        else:
+            self.play()
+
+    def stop(self) -> None:
+        self.finish()
+
+    def quit(self) -> None:
+        self.finish()
+
+    def end(self) -> None:
+        onEnd = type(self).onEnd  # plain function, not a method
+        if onEnd:
+            onEnd()
+        self.finish()
+
+    def finish(self) -> None:
+        with self.lock:
+            if self.done:
+                return
+            self.done = True
+            self.status = "Stopped"
+        if self.timer:
+            self.timer.cancel()
+        # the real wrapper reports the exit from its own thread once the process is gone
+        threading.Thread(target=self.exited, daemon=True).start()
+
+    def exited(self) -> None:
+        time.sleep(self.exit)
+        self.exitEvent(self, 0)
+
+
+def make_library(root, playlists, tracks) -> None:
+    for p in range(playlists):
+        folder = f"{root}/Playlist {p + 1}"
+        os.makedirs(f"{folder}/Disc 2")
+        for t in range(tracks):
+            # some tracks in a subfolder like a real album rip
+            sub = "Disc 2/" if t % 5 == 0 else ""
+            open(f"{folder}/{sub}Track {t + 1:03d}.mp3", "wb").close()
+
+
+def percentile(values, pct) -> float:
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def wait_until(condition, timeout) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+def run(args) -> str:
+    FakePlayer.spawn = args.spawn_ms / 1000
+    FakePlayer.exit = args.exit_ms / 1000
+    FakePlayer.length = args.track_ms / 1000
+    recorder = FakePlayer.recorder = Recorder()
+    timeout = 5 + 10 * (FakePlayer.spawn + FakePlayer.exit)
+    work = tempfile.mkdtemp(prefix="pimusicpod-bench-")
+    lost = 0
+    quiet = open(os.devnull, 'w') if not args.verbose else sys.stdout
+    with contextlib.redirect_stdout(quiet), contextlib.redirect_stderr(quiet):
+        make_library(f"{work}/music", args.playlists, args.tracks)
+        music = None
+        try:
+            music = MusicPlayer(scanRate=0, root=f"{work}/music", playerFactory=FakePlayer,
+                                indexPath=f"{work}/library.db", statePath=f"{work}/playback.json")
+            if not wait_until(lambda: len(music.playlists) == args.playlists, 30):
+                raise RuntimeError("library scan didn't finish")
+            # the length is only for natural ends, the other cases must not end by themselves
+            FakePlayer.onEnd = lambda: recorder.mark("natural end")
+            recorder.mark("first track")
+            music.play()
+            recorder.wait(timeout)
+            recorder.sounded.clear()
+
+            per = max(args.transitions // 4, 1)
+            for _ in range(per):
+                if not recorder.wait(timeout):
+                    lost += 1
+                recorder.sounded.clear()
+            FakePlayer.length = 3600  # nothing ends by itself from here on
+            FakePlayer.onEnd = None
+            # move past the short track that is still playing, without timing it
+            recorder.mark(None)
+            recorder.wait(timeout)
+            triggers = [("skip", music.skip), ("switch playlists", music.switch_playlists)]
+            for kind, action in triggers:
+                for _ in range(per):
+                    if not wait_until(lambda: music.player and music.player.is_playing(), timeout):
+                        lost += 1
+                        continue
+                    # let the prefetcher do its job like it would mid-song
+                    time.sleep(random.uniform(0, 2 * FakePlayer.spawn))
+                    recorder.mark(kind)
+                    action()
+                    if not recorder.wait(timeout):
+                        lost += 1
+            for _ in range(max(per // args.burst, 1)):
+                if not wait_until(lambda: music.player and music.player.is_playing(), timeout):
+                    lost += 1
+                    continue
+                for _ in range(args.burst):
+                    recorder.mark("rapid skip burst")
+                    music.skip()
+                    time.sleep(FakePlayer.exit / 2)
+                if not recorder.wait(timeout):
+                    lost += 1
+        finally:
+            if music:
+                music.closed = True
+                if music.player:
+                    music.player.quit()
+                music.watcher.stop()
+                music.snapshot.stop()
+                music.state.stop()
+                music.metadata.close()
+            shutil.rmtree(work, ignore_errors=True)
+            time.sleep(1)  # let the background threads notice before the output comes back
+
+    lines = [f"Fake omxplayer: spawn {args.spawn_ms:.0f} ms, exit {args.exit_ms:.0f} ms, "
+             f"track {args.track_ms:.0f} ms, {args.playlists} playlists x {args.tracks} tracks",
+             f"{'transition':<20}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+    for kind, values in recorder.latencies.items():
+        ms = [v * 1000 for v in values]
+        lines.append(f"{kind:<20}{len(ms):>7}{percentile(ms, 50):>10.1f}{percentile(ms, 95):>10.1f}"
+                     f"{percentile(ms, 99):>10.1f}{max(ms):>10.1f}")
+    if lost:
+        lines.append(f"{lost} transitions never produced sound within {timeout:.0f}s")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--transitions", type=int, default=1000,
+                        help="total transitions, split between natural ends, skips and switches")
+    parser.add_argument("--burst", type=int, default=5, help="skips per rapid skip burst")
+    parser.add_argument("--spawn-ms", type=float, default=40, help="fake omxplayer startup cost")
+    parser.add_argument("--exit-ms", type=float, default=5, help="fake omxplayer shutdown cost")
+    parser.add_argument("--track-ms", type=float, default=100, help="fake track length")
+    parser.add_argument("--playlists", type=int, default=3)
+    parser.add_argument("--tracks", type=int, default=50, help="tracks per playlist")
+    parser.add_argument("-o", "--output", help="also write the report to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the player's own output")
+    args = parser.parse_args()
+    report = run(args)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(report + "\n")
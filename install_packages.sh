@@ -15,7 +15,7 @@ echo "Updating system..."
 sudo apt update && sudo apt upgrade -y
 
 echo "Installing system package dependencies..."
-sudo apt install -y python3-pip python3-venv libopenjp2-7 pulseaudio pulseaudio-module-bluetooth omxplayer
+sudo apt install -y python3-pip python3-venv libopenjp2-7 libdbus-1-dev libglib2.0-dev libgirepository1.0-dev libcairo2-dev pkg-config python3-dev pulseaudio pulseaudio-module-bluetooth omxplayer
 clear
 
 echo "Creating virtual environment for Python..."
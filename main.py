@@ -1,25 +1,32 @@
 from __future__ import annotations
+import time
+BOOT_STARTED = time.monotonic()  # boot timings count from here, before the slow imports
 from luma.core.interface.serial import i2c, spi
-from luma.core.render import canvas
 from luma.oled.device import sh1106
 import RPi.GPIO as GPIO
-from PIL import ImageFont
 import os
 import sys
-import time
 import json
-from subprocess import check_output, Popen, CalledProcessError, DEVNULL, PIPE
+import threading
+from functools import partial
+from subprocess import check_output, CalledProcessError
 
 from modules.music import MusicPlayer, InputManager
-from modules.bluetooth import BTHack
-from modules.elements import Text, Button, Toggle, Feed, Menu, Prompt, Slider
+from modules.bluetooth import BTHack, BlueZ, DeviceRegistry
+from modules.elements import Text, Button, Toggle, Feed, Menu, Prompt, Slider, ListModel
+from modules.keypad import Keypad
+from modules.display import DiffDisplay, FrameBuffer, FrameScheduler, font
+from modules.boot import BootProgress
 
 
 def get_settings():
     defaults = {
         "brightness": 50,
         "sleep-delay": 10,
-        "reshuffle": 1
+        "reshuffle": 1,
+        "scan-rate": 50,
+        "repeat-delay": 0.4,
+        "frame-rate": 30
     }
     if not os.path.exists("settings.json"):
         obj = json.dumps(defaults, indent=4)
@@ -31,8 +38,6 @@ def get_settings():
     return settings
 
 
-font = ImageFont.load_default()
-
 padding = -2
 top = padding
 line_pad = [top, top+8, top+16, top+25, top+34, top+43, top+52]
@@ -63,24 +68,19 @@ GPIO.setup(KEY3_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
 
 class BTListElement():
-    def __init__(self, output: str):
-        params = output.split(' ', 2)
-        self.name = params[2]
-        self.mac = params[1]
+    def __init__(self, name: str, mac: str):
+        self.name = name
+        self.mac = mac
 
     def __str__(self): return self.name
 
 
 class ScreenMaster():
     # screen controller
-    def __init__(self, settings):
+    def __init__(self, settings, boot=None):
         self.toggle = True
         self.wifi = True
-        self.scanner = None
-        # music controller
-        self.music = MusicPlayer()
-        # listen to button presses on bluetooth speaker
-        self.manager = InputManager(self.music)
+        self.scanner = False
         self.settings = settings
         print(self.settings)
         self.brightness = self.settings["brightness"]
@@ -91,85 +91,150 @@ class ScreenMaster():
 
         serial = spi(device=0, port=0, bus_speed_hz=8000000,
                      transfer_size=4096, gpio_DC=DC_PIN, gpio_RST=RST_PIN)
-        self.device = sh1106(serial, rotate=2)  # sh1106
+        # only the parts of a frame that changed go over SPI
+        self.device = DiffDisplay(sh1106(serial, rotate=2))  # sh1106
+        # every screen draws into this one image instead of a new canvas per frame
+        self.frame = FrameBuffer(self.device)
+        # everything that wants to change the screen goes through here
+        self.screen = FrameScheduler(self.frame, settings.get("frame-rate", 30))
         self.device.show()
+        # the screen comes first, everything slow happens behind the menu
+        self.boot = boot or BootProgress()
+        self.DisplayText(["Pi MP3 Player", "", "Starting..."])
+        if self.screen.flush():
+            self.boot.mark("first frame")
+
+        # key presses arrive here from GPIO interrupts, the menus block on it
+        self.keypad = Keypad([KEY_UP_PIN, KEY_DOWN_PIN, KEY_LEFT_PIN, KEY_RIGHT_PIN,
+                              KEY_PRESS_PIN, KEY1_PIN, KEY2_PIN, KEY3_PIN],
+                             repeatDelay=settings.get("repeat-delay", 0.4))
+        self.boot.onChange = self.keypad.redraw
+        self.boot.stage("Library", "...")
+        self.boot.stage("BT", "...")
+        # one D-Bus connection to bluetoothd for everything bluetooth
+        self.bluez = BlueZ.shared()
+        # devices come in from bluetoothd's signals, the menus just read this
+        self.devices = DeviceRegistry(self.bluez)
+        # music controller, the library gets scanned in the background
+        self.music = MusicPlayer(settings.get("scan-rate", 50))
+        self.music.onScan = self.on_scan
+        self.music.onPlay = self.on_play
+        if self.music.scanned.is_set():
+            self.on_scan(len(self.music.playlists), True)  # done before the callback was set
+        # song titles show up as their tags get read
+        self.music.metadata.onUpdate = self.on_metadata
+        # listen to button presses on bluetooth speaker
+        self.manager = InputManager(self.music, self.bluez, self.devices)
 
-        self.bthack = BTHack()  # hacky tool for fixing pulseaudio issues
+        self.bthack = BTHack(self.bluez)  # hacky tool for fixing pulseaudio issues
 
         self.curDevice = None
 
+    def on_metadata(self, path) -> None:
+        self.music.on_metadata(path)
+        self.keypad.redraw()
+
+    def on_scan(self, found, done) -> None:
+        if done:
+            self.boot.finish("Library", found > 0)
+        else:
+            self.boot.update("Library", str(found))
+
+    def on_play(self, path) -> None:
+        self.boot.mark("first sound")
+
+    def start_services(self, recover=True) -> None:
+        """
+        Gets bluetooth ready in the background while the library is being scanned,
+        the main menu shows how far along both are
+        """
+        threading.Thread(target=self.bring_up_bluetooth, args=(recover,), daemon=True).start()
+
+    def bring_up_bluetooth(self, recover=True) -> None:
+        progress = 100
+        if recover:
+            progress = 0
+            # clear up funkiness with pulseaudio/dbus
+            for s, phase in self.bthack.recover(speaker=False):
+                progress = max(min(progress + s, 100), 0)
+                self.boot.update("BT", f"{progress}%")
+        self.boot.finish("BT", progress == 100)
+        # the speaker is ready, continue whatever was playing before the last shutdown
+        self.music.resume_playback()
+
+    def boot_status(self) -> str:
+        return self.boot.status()
+
     def toggle_screen(self) -> None:
         self.toggle = not self.toggle
         if not self.toggle:
             self.device.hide()
         else:
             self.device.show()
-        time.sleep(1)
 
     def DisplayText(self, lines, selection=None, topLeft=()) -> None:
         # simple routine to display 7 lines of text
-        with canvas(self.device) as draw:
-            for i, l in enumerate(lines):
-                draw.text((0, line_pad[i]), l,  font=font, fill=255)
-            if selection != None:
-                draw.text((0, line_pad[selection]), '>',  font=font, fill=255)
-            if topLeft:
-                draw.text((topLeft[0], line_pad[0]),
-                          topLeft[1],  font=font, fill=255)
+        self.screen.show(partial(self.draw_text, list(lines), selection, topLeft))
+
+    def draw_text(self, lines, selection, topLeft, draw) -> None:
+        for i, l in enumerate(lines):
+            draw.text((0, line_pad[i]), l,  font=font, fill=255)
+        if selection != None:
+            draw.text((0, line_pad[selection]), '>',  font=font, fill=255)
+        if topLeft:
+            draw.text((topLeft[0], line_pad[0]),
+                      topLeft[1],  font=font, fill=255)
+
+    def show_progress(self, title, progress=0) -> None:
+        def paint(draw):
+            draw.text((0, line_pad[0]), title,  font=font, fill=255)
+            draw.rectangle(((14, 28), (114, 36)), outline=255, fill=0)  # outer rect
+            if progress:
+                draw.rectangle(((14, 28), (max(14, round(114 * (progress/100))), 36)),
+                               outline=255, fill=255)  # inner rect
+        self.screen.show(paint)
 
     def confirm_prompt(self, prompt="Are you sure?") -> bool:
         print("Asking for confirmation")
         confOpts = [prompt, "  Yes", "  No"]
         confSelect = 2
         self.DisplayText(confOpts, confSelect)
-        time.sleep(0.5)
-        while GPIO.input(KEY_LEFT_PIN):
-            if not GPIO.input(KEY_UP_PIN):  # button is released
+        while True:
+            key = self.keypad.wait(repeat=(KEY_UP_PIN, KEY_DOWN_PIN))
+            if key == KEY_LEFT_PIN:
+                return False
+            elif key == KEY_UP_PIN:
                 if confSelect == 1:
                     confSelect = (len(confOpts) - 1)
                 else:
                     confSelect -= 1
-                self.DisplayText(confOpts, confSelect)
-                time.sleep(0.5)
-
-            if not GPIO.input(KEY_DOWN_PIN):  # button is released
+            elif key == KEY_DOWN_PIN:
                 if confSelect >= (len(confOpts) - 1):
                     confSelect = 1
                 else:
                     confSelect += 1
-                self.DisplayText(confOpts, confSelect)
-                time.sleep(0.5)
-
-            if not GPIO.input(KEY_PRESS_PIN) or not GPIO.input(KEY_RIGHT_PIN):
-                if confSelect == 1:
-                    return True
-                else:
-                    return False
-        return False
+            elif key == KEY_PRESS_PIN or key == KEY_RIGHT_PIN:
+                return confSelect == 1
+            self.DisplayText(confOpts, confSelect)
 
     def list_devices(self, paired=False) -> list[BTListElement]:
         """Returns a list of bluetooth devices, each with keys\n
         `name` The name of the device\n
         `mac` The MAC address of the device"""
-        if paired:
-            output = check_output(
-                "bluetoothctl paired-devices".split(' ')).decode().split('\n')
-        else:
-            output = check_output(
-                "bluetoothctl devices".split(' ')).decode().split('\n')
-        # print(output)
         devices = []
-        for d in output:
-            if d == '' or len(d.split('-')) >= 5 or 'RSSI' in d or 'harp' in d.lower() or 'ble' in d.lower():
+        for d in self.devices.devices(paired=True if paired else None):
+            # nameless devices are only known by their address
+            if not d['name'] or 'harp' in d['name'].lower() or 'ble' in d['name'].lower():
                 continue
-            devices.append(BTListElement(d))
+            devices.append(BTListElement(d['name'], d['mac']))
         return devices
 
     def run_bt_script(self, prompt="Running script...") -> None:
-        with canvas(self.device) as draw:
-            draw.text((0, line_pad[0]), prompt,  font=font, fill=255)
-            draw.rectangle(((14, 28), (114, 36)), outline=255, fill=0)
-        time.sleep(2)
+        if not self.boot.is_ready("BT"):
+            self.DisplayText([prompt, "Still starting up..."])
+            time.sleep(2)
+            return
+        self.show_progress(prompt)
         progress = 0
         if self.music.player:
             try:
@@ -179,23 +244,16 @@ class ScreenMaster():
                 print(e)
             finally:
                 self.music.player = None
-        # function yields integers for each step, accumulated to progress value
-        for s in self.bthack.initiate(True, True):
+        # yields the increment and the phase for each step, accumulated to progress value
+        for s, phase in self.bthack.recover(speaker=False):
             progress = max(min(progress + s, 100), 0)  # clamp to 100%
-            with canvas(self.device) as draw:
-                draw.text((0, line_pad[0]), prompt + "{}%".format(progress),  font=font, fill=255)
-                draw.rectangle(((14, 28), (114, 36)),
-                               outline=255, fill=0)  # outer rect
-                draw.rectangle(
-                    ((14, 28), (round(114 * (progress/100)), 36)), outline=255, fill=255)  # inner rect
-        if progress == 100:
-            with canvas(self.device) as draw:
-                draw.text((0, line_pad[0]),
-                          "Script succesful!",  font=font, fill=255)
-                draw.rectangle(((14, 28), (114, 36)),
-                               outline=255, fill=255)  # full bar
+            self.show_progress(f"{phase} {progress}%", progress)
+        if progress < 100:
+            self.DisplayText([prompt, "Script failed!"])
+        elif self.bthack.repaired:
+            self.show_progress("Script succesful!", 100)  # full bar
         else:
-            self.DisplayText([prompt, "Script failed!"])  # shouldn't happen
+            return  # everything was fine, nothing worth showing
         time.sleep(2)
 
     def save_settings(self) -> None:
@@ -218,22 +276,21 @@ class ScreenMaster():
         if toggle:
             if self.scanner:
                 return
-            self.scanner = Popen(
-                ['bluetoothctl', 'scan', 'on'], stderr=PIPE, close_fds=True)
+            try:
+                self.bluez.start_discovery()
+            except Exception as e:
+                print(e)
+                return
+            self.scanner = True
             print("Scanning for bluetooth devices...")
         else:
             if self.scanner:
                 try:
-                    self.scanner.terminate()
+                    self.bluez.stop_discovery()
                 except Exception:
                     pass
                 finally:
-                    try:
-                        check_output("bluetoothctl scan off".split(
-                            ' '), stderr=DEVNULL)
-                    except Exception:
-                        pass
-                    self.scanner = None
+                    self.scanner = False
                 print("Stopped scanning for bluetooth devices...")
 
     def is_device_connected(self) -> bool:
@@ -251,10 +308,11 @@ class ScreenMaster():
         if self.curDevice:
             yield (self.curDevice['name'], "Disconnecting...")
             time.sleep(1)
+            self.manager.reconnect.follow(None)  # on purpose, don't get it back
             try:
-                check_output(
-                    f"bluetoothctl disconnect {self.curDevice['mac']}".split(' '))
-            except Exception as e:
+                self.bluez.disconnect(self.curDevice['mac'])
+            except Exception:
+                self.manager.reconnect.follow(self.curDevice['mac'])
                 yield True
                 yield (self.curDevice['name'], "Error disconnecting!")
                 time.sleep(2)
@@ -275,15 +333,15 @@ class ScreenMaster():
         """
         print(
             f"Selected '{device['name']}' with MAC: {device['mac']}")
-        # yes, i know i should be using the bluetooth module...
-        info = check_output(f"bluetoothctl info {device['mac']}".split(
-            ' ')).decode().replace('\t', '').split('\n')
+        info = self.devices.get(device['mac']) or self.bluez.info(device['mac'])
         if device['paired']:
             print("remove")
             yield (device['name'], "Removing...")
             time.sleep(1)
+            if self.curDevice and self.curDevice['mac'] == device['mac']:
+                self.manager.reconnect.follow(None)
             try:
-                check_output(f"bluetoothctl remove {device['mac']}".split(' '))
+                self.bluez.remove(device['mac'])
             except Exception as e:
                 print(e)
                 yield True
@@ -296,14 +354,13 @@ class ScreenMaster():
         else:
             print("connect")
             pairError = False
-            if not 'Paired: yes' in info:
+            if not info['paired']:
                 yield (device['name'], "Trying to pair...")
                 time.sleep(2)
                 for i in range(3):
                     try:
-                        check_output(
-                            f"bluetoothctl pair {device['mac']}".split(' '))
-                    except Exception as e:
+                        self.bluez.pair(device['mac'])
+                    except Exception:
                         time.sleep(4)
                     else:
                         break
@@ -315,13 +372,12 @@ class ScreenMaster():
                     time.sleep(3)  # give user time to read
             if not pairError:
                 connectError = False
-                if not 'Connected: yes' in info:
+                if not info['connected']:
                     yield True  # yielding True clears the screen
                     yield (device['name'], "Paired", "Trying to connect...")
                     time.sleep(3)
                     try:
-                        check_output(
-                            f"bluetoothctl connect {device['mac']}".split(' '))
+                        self.bluez.connect(device['mac'])
                     except Exception as e:
                         print(e)
                         try:
@@ -333,31 +389,23 @@ class ScreenMaster():
                         check_output(["pulseaudio", "--start"])
                         time.sleep(2)
                         try:
-                            check_output(
-                                f"bluetoothctl connect {device['mac']}".split(' '))
+                            self.bluez.connect(device['mac'])
                         except Exception:
                             yield True
                             yield (device['name'], "Paired", "Failed to connect!")
                             connectError = True
                             time.sleep(3)
                 if not connectError:
-                    if self.scanner:
-                        try:
-                            self.scanner.terminate()
-                        except Exception:
-                            pass
-                        finally:
-                            self.scanner = None
+                    self.toggle_bt_scan(False)
                     self.curDevice = device
-                    self.manager.mac = device['mac']
+                    self.manager.reconnect.follow(device['mac'])
                     yield True
                     yield (device['name'], "Connected!")
                     time.sleep(3)
-                    if not 'Trusted: yes' in info:
+                    if not info['trusted']:
                         trust = self.confirm_prompt(f"Trust {device['name']}?")
                         if trust:
-                            check_output(
-                                f"bluetoothctl trust {device['mac']}".split(' '))
+                            self.bluez.set_trusted(device['mac'])
                 return True
 
     def menu_device_list(self, paired=False) -> list[Feed]:
@@ -392,83 +440,130 @@ class ScreenMaster():
                 self.music.definitive_switch(i)
 
     def get_playlists(self) -> list[Button]:
-        return [Button(f" {playlist.name}", self.set_playlist, playlist.name) for playlist in self.music.playlists]
+        playlists = [Button(f" {playlist.name} ({playlist.totalTracks})", self.set_playlist, playlist.name) for playlist in self.music.playlists]
+        if not self.boot.is_ready("Library"):
+            playlists.append(Text("  Scanning..."))
+        return playlists
 
-    def has_event0(self) -> bool:
-        """
-        Checks if event0 is found as an input device.
-        """
-        return str(os.path.exists('/dev/input/event0'))
+    def media_keys(self) -> str:
+        """Names the speakers and remotes whose media keys are being listened to"""
+        names = self.manager.keys.names()
+        return ", ".join(names) if names else "None"
 
     # playback helper functions
-    def make_song_next(self, songIndex=0):
-        if (songIndex == 0):
+    # songs are referenced by their queue entry id, indexes go stale as the queue moves
+    def make_song_next(self, entryId):
+        queue = self.music.playlists[self.music.playlistIndex].tracks
+        songIndex = queue.index_of(entryId)
+        if (songIndex <= 0):
             return
         newIndex = 0
         if (self.music.player):
             newIndex = 1  # dont remove spot of currently playing song
-        self.music.playlists[self.music.playlistIndex].tracks.insert(
-            newIndex, self.music.playlists[self.music.playlistIndex].tracks.pop(songIndex))
+        queue.move(songIndex, newIndex)
 
-    def make_song_last(self, songIndex):
+    def make_song_last(self, entryId):
         # bring song to the bottom of the queue
-        if (songIndex == 0 and self.music.now == self.music.playlists[self.music.playlistIndex].tracks[songIndex]):
+        queue = self.music.playlists[self.music.playlistIndex].tracks
+        songIndex = queue.index_of(entryId)
+        if (songIndex < 0 or songIndex == 0 and self.music.player):
             return
-        self.music.playlists[self.music.playlistIndex].tracks.append(
-            self.music.playlists[self.music.playlistIndex].tracks.pop(songIndex))
+        queue.move(songIndex, len(queue) - 1)
 
-    def remove_queued_song(self, songIndex):
+    def remove_queued_song(self, entryId):
         # remove song from queue
-        if (songIndex == 0):
+        queue = self.music.playlists[self.music.playlistIndex].tracks
+        if (queue.index_of(entryId) <= 0):
             return
-        self.music.playlists[self.music.playlistIndex].tracks.pop(songIndex)
+        queue.remove_entry(entryId)
 
-    def music_queue_list(self) -> list[Menu]:
+    def music_queue_list(self) -> ListModel | list[Text]:
         """
-        Returns the current queue of songs as menu elements
+        Returns the current queue of songs as a list model,
+        menu elements only get made for the page on screen
         """
-        _songs = [
-            f"{track[:-4]}" for track in self.music.playlists[self.music.playlistIndex].tracks]  # list of song names
-
-        if len(_songs) > 0:
-            songs = []  # list of songs as interactable menu objects
-            for i, s in enumerate(_songs):
-                _songMenu = [Text(s),
-                             Button("  Play next", self.make_song_next, i),
-                             Button("  Play last", self.make_song_last, i),
-                             Button("  Remove", self.remove_queued_song, i)]
-                _song = Menu(self, f"{s}",
-                             _songMenu, (1,), submenu=True, autoclose=True)
-                songs.append(_song)
-            return songs  # menu objects to display
+        if not self.music.playlists:
+            return [Text("  Scanning library...")]
+        playlist = self.music.playlists[self.music.playlistIndex]
+        queue = playlist.tracks
+        if len(queue) > 0:
+            return ListModel(queue.__len__, lambda i: self.song_entry(playlist, *queue.entry(i)),
+                             partial(self.sorted_queue, playlist))
         else:
             return [Text("  Queue is empty!")]
 
+    def song_entry(self, playlist, entryId, track) -> Menu:
+        """A queued song as a menu element, its tags get read once it's on screen"""
+        title = self.music.metadata.title(self.music.track_path(playlist, track))
+        # songs still waiting in the shuffle only get an entry once they're opened
+        updater = partial(self.song_menu, entryId) if entryId else partial(self.queued_song_menu, track)
+        return Menu(self, f"{title}", None, (3,), updater=updater,
+                    submenu=True, autoclose=True)
+
+    def sorted_queue(self, playlist) -> ListModel:
+        # built once per queue and kept sorted from then on, flipping views is free
+        index = self.music.sorted_queue(playlist)
+        return ListModel(index.__len__, lambda i: self.song_entry(playlist, 0, index[i]), index=index)
+
+    def queued_song_menu(self, track) -> list:
+        queue = self.music.playlists[self.music.playlistIndex].tracks
+        try:
+            queue.index(track)  # draws the shuffle up to the song
+        except ValueError:
+            pass
+        return self.song_menu(queue.entry_of(track))
+
+    def song_menu(self, entryId) -> list:
+        """Returns the tag info and actions of a queued song"""
+        playlist = self.music.playlists[self.music.playlistIndex]
+        songIndex = playlist.tracks.index_of(entryId)
+        if songIndex < 0:
+            return [Text("  No longer queued"), Text(""), Text(""), Button("  Back")]
+        path = self.music.track_path(playlist, playlist.tracks[songIndex])
+        meta = self.music.metadata.get(path)
+        if meta:
+            info = [Text(meta.title),
+                    Text(f"  {meta.artist or 'Unknown artist'}"),
+                    Text(f"  {meta.album or 'Unknown album'} {meta.length()}")]
+        else:
+            info = [Text(self.music.metadata.title(path)),
+                    Text("  Reading tags..."), Text("")]
+        return info + [Button("  Play next", self.make_song_next, entryId),
+                       Button("  Play last", self.make_song_last, entryId),
+                       Button("  Remove", self.remove_queued_song, entryId)]
+
     def get_cur_playlist(self) -> str:
+        if not self.music.playlists:
+            return "None"
         return self.music.playlists[self.music.playlistIndex].name
 
     def get_cur_song(self) -> str:
         if self.music.player:
-            # remove '.mp3' extension from end of string
-            return self.music.player.get_source().split('/')[-1][:-4]
+            return self.music.metadata.title(self.music.state.source)
         else:
             return "None"
 
     def get_play_status(self) -> str:
-        return "Pause" if self.music.player and self.music.now != None and self.music.player.is_playing() else "Play"
+        if not self.boot.is_ready("BT"):
+            return "Play (starting)"
+        return "Pause" if self.music.player and self.music.now != None and self.music.state.is_playing() else "Play"
 
     def toggle_playback(self) -> None:
-        if not self.curDevice:
+        if not self.curDevice or not self.boot.is_ready("BT"):
             return
         if self.music.player:
-            self.music.toggle_pause(self.manager)
+            self.music.toggle_pause()
         else:
-            self.music.play(self.manager)
+            self.music.play()
 
     def skip_song(self) -> None:
         self.music.now = None
         self.music.skip()
 
+    def rebuild_library(self) -> None:
+        self.DisplayText(["Rebuilding index..."])
+        self.music.rebuild_library()
+
     def reboot_sys(self): os.system("sudo reboot -h now")
     def shutdown_sys(self): os.system("sudo shutdown -h now")
 
@@ -478,7 +573,7 @@ class ScreenMaster():
         # we pass the ScreenMaster instance to elements that need to takeover drawing
         musicPage = [Text("Now: ", self.get_cur_song),
                      Text("From: ", self.get_cur_playlist),
-                     Text("Media Keys: ", self.has_event0),
+                     Text("Media Keys: ", self.media_keys),
                      Button(Text("  ", self.get_play_status),
                             self.toggle_playback),
                      Button("  Skip", self.skip_song),
@@ -498,6 +593,7 @@ class ScreenMaster():
                       Prompt(self, "  Reboot", self.reboot_sys),
                       Prompt(self, "  Shutdown", self.shutdown_sys),
                       Prompt(self, "  BT Script", self.run_bt_script),
+                      Prompt(self, "  Rebuild Index", self.rebuild_library),
                       Prompt(self, "  Disable WiFi", None)]
         settingsPage = [Slider(self, "  Brightness", self.device, self.settings['brightness'], self.save_brightness),
                         Toggle("  Reshuffle", self.reshuffle == 1, self.save_reshuffle)]
@@ -506,32 +602,32 @@ class ScreenMaster():
                    Menu(self, "Music", musicPage, (3,), submenu=True),
                    Menu(self, "Bluetooth", bluetoothPage, (2,), submenu=True),
                    Menu(self, "System", systemPage, (1,), submenu=True),
-                   Menu(self, "Settings", settingsPage, (0,), submenu=True)]
-        menu = Menu(self, "Main", options, (1,), btn1=self.toggle_screen)
+                   Menu(self, "Settings", settingsPage, (0,), submenu=True),
+                   Text("", self.boot_status)]
+        menu = Menu(self, "Main", options, (1, 4), btn1=self.toggle_screen)
         menu.activate()
 
 
 if __name__ == '__main__':
-    master = ScreenMaster(get_settings()) # load user configuration
-    if len(sys.argv) == 1:
-        # clear up funkiness with pulseaudio/dbus
-        master.run_bt_script("Initializing...")
+    master = ScreenMaster(get_settings(), BootProgress(BOOT_STARTED)) # load user configuration
+    # the menu comes up right away, bluetooth and the library get ready behind it
+    master.start_services(recover=len(sys.argv) == 1)
     try:
         master.initiate()  # draw the mp3 player menu
     except KeyboardInterrupt:
         print("haulting!")
-        if master.manager.thread:
-            try:
-                master.manager.thread.terminate()
-            except Exception:
-                pass
-            else:
-                print("Input listener terminated!")
+        # stop listening for media key presses from your speaker
+        master.manager.close()
+        # remember the queue and position for the next start
+        master.music.snapshot.flush()
         # close music player so it doesn't load songs after exit
         master.music.closed = True
-        # tell the input listener thread to die, can't terminate like subprocess
-        master.manager.shouldDie = True
-        # thread listens for media key presses from your speaker,
+        master.keypad.close()
+        master.screen.stop()
+        print(f"Frames: {master.screen.report()}")
+        print(f"Display: {master.device.report()}")
+        print(f"Speaker: {master.manager.reconnect.report()}")
+        # the media keys thread notices within a second
         # Ex: pressing play/pause button on speaker won't work natively, so i programmed this workaround
-        if master.manager.thread and master.manager.thread.is_alive():
-            master.manager.thread.join(timeout=7)
+        if master.manager.keys.thread and master.manager.keys.thread.is_alive():
+            master.manager.keys.thread.join(timeout=2)
@@ -1,117 +1,519 @@
 from subprocess import check_output, CalledProcessError, DEVNULL
 import time, os
+import threading
+from collections import namedtuple
+import dbus
+try:
+    # signals need a main loop, without one the device list is polled instead
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+except ImportError:
+    DBusGMainLoop = None
+
+BLUEZ = "org.bluez"
+ADAPTER = "org.bluez.Adapter1"
+DEVICE = "org.bluez.Device1"
+OBJECT_MANAGER = "org.freedesktop.DBus.ObjectManager"
+PROPERTIES = "org.freedesktop.DBus.Properties"
+# the bus itself went away, e.g. after "service dbus restart"
+LOST_BUS = ("org.freedesktop.DBus.Error.Disconnected", "org.freedesktop.DBus.Error.NoServer")
+
+
+class BlueZ:
+    """
+    Talks to bluetoothd over D-Bus instead of forking `bluetoothctl` for every command.
+
+    Everything goes over one bus connection, shared by the whole process through
+    `BlueZ.shared()`. Device lookups read BlueZ's ObjectManager tree, a device's
+    object path comes straight from its MAC address. Failed calls raise
+    `dbus.exceptions.DBusException`.
+
+    Attributes:
+        `bus`           D-Bus connection to use, the system bus if None\n
+        `adapter`       Object path of the adapter, the first one found if None\n
+        `signals`       Whether signal handlers get called, needs a main loop. By default
+        true when the GLib bindings are installed
+    """
+    instance = None
+    instanceLock = threading.Lock()
+    mainloop = None
+
+    def __init__(self, bus=None, adapter=None, signals=None):
+        self.own = bus is None  # only a connection we opened gets reopened
+        self.signals = DBusGMainLoop is not None if signals is None else signals
+        self.subscriptions = []  # applied again on every new connection
+        # opened on first use, at boot the bus may be what needs repairing
+        self.bus = bus
+        self.busLock = threading.Lock()
+        self.adapter = adapter
+
+    @classmethod
+    def shared(cls):
+        with cls.instanceLock:
+            if cls.instance is None:
+                cls.instance = cls()
+            return cls.instance
+
+    def open_bus(self):
+        if not self.signals:
+            return dbus.SystemBus(private=True)
+        bus = dbus.SystemBus(private=True, mainloop=DBusGMainLoop())
+        with BlueZ.instanceLock:
+            if BlueZ.mainloop is None:
+                # signal handlers run on this thread
+                BlueZ.mainloop = threading.Thread(target=GLib.MainLoop().run, daemon=True)
+                BlueZ.mainloop.start()
+        for subscribe in self.subscriptions:
+            subscribe(bus)
+        return bus
+
+    def subscribe(self, subscribe) -> bool:
+        """
+        Registers signal handlers, `subscribe` gets called with the bus now and
+        after every reconnect. Returns False if signals aren't available
+        """
+        if not self.signals:
+            return False
+        with self.busLock:
+            self.subscriptions.append(subscribe)
+            if self.bus is not None:
+                subscribe(self.bus)
+        return True
+
+    def ensure_bus(self):
+        with self.busLock:
+            if self.bus is None:
+                self.bus = self.open_bus()
+            return self.bus
+
+    def call(self, action):
+        """Runs `action`, once more on a new connection if the bus went away under it"""
+        bus = None
+        try:
+            bus = self.ensure_bus()
+            return action()
+        except dbus.exceptions.DBusException as e:
+            if not self.own or e.get_dbus_name() not in LOST_BUS:
+                raise
+            self.reopen_bus(bus)
+            return action()
+
+    def reopen_bus(self, failed) -> None:
+        """Replaces the connection `failed`, unless another thread already did"""
+        with self.busLock:
+            if self.bus is not failed:
+                return
+            print("Lost the system bus, reconnecting")
+            self.bus = self.open_bus()
+        if failed is not None:
+            try:
+                failed.close()  # takes the old signal handlers with it
+            except dbus.exceptions.DBusException:
+                pass
+
+    def interface(self, path, name):
+        return dbus.Interface(self.bus.get_object(BLUEZ, path), name)
+
+    def objects(self) -> dict:
+        return self.call(lambda: self.interface("/", OBJECT_MANAGER).GetManagedObjects())
+
+    def adapter_path(self) -> str:
+        if self.adapter is None:
+            self.adapter = next((path for path, ifaces in self.objects().items() if ADAPTER in ifaces), None)
+            if self.adapter is None:
+                raise dbus.exceptions.DBusException("No bluetooth adapter found",
+                                                    name="org.bluez.Error.NotReady")
+        return str(self.adapter)
+
+    def device_path(self, mac) -> str:
+        return f"{self.adapter_path()}/dev_{mac.upper().replace(':', '_')}"
+
+    @staticmethod
+    def describe(path, props) -> dict:
+        """Device properties as plain Python values"""
+        rssi = props.get("RSSI")
+        return {"path": str(path),
+                "mac": str(props.get("Address", "")),
+                "name": str(props["Name"]) if "Name" in props else None,
+                "paired": bool(props.get("Paired", False)),
+                "connected": bool(props.get("Connected", False)),
+                "trusted": bool(props.get("Trusted", False)),
+                "rssi": int(rssi) if rssi is not None else None}
+
+    def devices(self, paired=None) -> list:
+        """Every device BlueZ knows of, only the (un)paired ones if `paired` is set"""
+        found = []
+        for path, ifaces in self.objects().items():
+            if DEVICE not in ifaces:
+                continue
+            device = self.describe(path, ifaces[DEVICE])
+            if paired is None or device["paired"] == paired:
+                found.append(device)
+        return found
+
+    def info(self, mac) -> dict:
+        path = self.device_path(mac)
+        return self.describe(path, self.call(lambda: self.interface(path, PROPERTIES).GetAll(DEVICE)))
+
+    def running(self) -> bool:
+        """Whether bluetoothd is on the bus, raises if the bus itself is down"""
+        daemon = lambda: dbus.Interface(self.bus.get_object("org.freedesktop.DBus", "/org/freedesktop/DBus"),
+                                        "org.freedesktop.DBus")
+        return bool(self.call(lambda: daemon().NameHasOwner(BLUEZ)))
+
+    def powered(self) -> bool:
+        path = self.adapter_path()
+        return bool(self.call(lambda: self.interface(path, PROPERTIES).Get(ADAPTER, "Powered")))
+
+    def is_connected(self, mac) -> bool:
+        try:
+            return self.info(mac)["connected"]
+        except dbus.exceptions.DBusException:
+            return False  # BlueZ doesn't know the device (anymore)
+
+    def device_call(self, mac, method, timeout=60) -> None:
+        path = self.device_path(mac)
+        self.call(lambda: getattr(self.interface(path, DEVICE), method)(timeout=timeout))
+
+    def pair(self, mac) -> None:
+        try:
+            self.device_call(mac, "Pair")
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() != "org.bluez.Error.AlreadyExists":
+                raise
+
+    def connect(self, mac) -> None:
+        self.device_call(mac, "Connect")
+
+    def disconnect(self, mac) -> None:
+        self.device_call(mac, "Disconnect")
+
+    def set_trusted(self, mac, trusted=True) -> None:
+        path = self.device_path(mac)
+        self.call(lambda: self.interface(path, PROPERTIES).Set(DEVICE, "Trusted", dbus.Boolean(trusted)))
+
+    def remove(self, mac) -> None:
+        path = self.device_path(mac)
+        self.call(lambda: self.interface(self.adapter_path(), ADAPTER).RemoveDevice(dbus.ObjectPath(path)))
+
+    def power(self, on=True) -> None:
+        self.call(lambda: self.interface(self.adapter_path(), PROPERTIES).Set(ADAPTER, "Powered", dbus.Boolean(on)))
+
+    def start_discovery(self) -> None:
+        try:
+            self.call(lambda: self.interface(self.adapter_path(), ADAPTER).StartDiscovery())
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() != "org.bluez.Error.InProgress":
+                raise
+
+    def stop_discovery(self) -> None:
+        try:
+            self.call(lambda: self.interface(self.adapter_path(), ADAPTER).StopDiscovery())
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() != "org.bluez.Error.Failed":  # wasn't discovering
+                raise
+
+
+class DeviceRegistry:
+    """
+    Every bluetooth device BlueZ knows of, kept in memory so the device menus
+    show up instantly instead of asking bluetoothd each time.
+
+    It's filled once from the ObjectManager and then follows the InterfacesAdded,
+    InterfacesRemoved and PropertiesChanged signals, so devices found while
+    scanning appear with their latest signal strength. Unpaired devices that
+    weren't heard from in `maxAge` seconds are dropped. Without a main loop for
+    the signals it refreshes itself when read, at most every `pollInterval` seconds.
+
+    Attributes:
+        `bluez`         The `BlueZ` client\n
+        `maxAge`        Seconds an unpaired device stays listed after it was last heard from\n
+        `pollInterval`  Seconds between refreshes when signals aren't available
+    """
+
+    def __init__(self, bluez, maxAge=120, pollInterval=5):
+        self.bluez = bluez
+        self.maxAge = maxAge
+        self.pollInterval = pollInterval
+        self.lock = threading.Lock()
+        self.props = {}  # object path -> Device1 properties
+        self.seen = {}  # object path -> last time it was heard from
+        self.refreshed = None  # None until a refresh went through
+        self.watchers = []  # called with every device that changed and whether it's still there
+        # filled on the first read or once the bus is up, not while the app is still booting
+        self.live = bluez.subscribe(self.subscribe)
+
+    def subscribe(self, bus) -> None:
+        bus.add_signal_receiver(self.on_added, "InterfacesAdded", OBJECT_MANAGER, BLUEZ)
+        bus.add_signal_receiver(self.on_removed, "InterfacesRemoved", OBJECT_MANAGER, BLUEZ)
+        bus.add_signal_receiver(self.on_changed, "PropertiesChanged", PROPERTIES, BLUEZ,
+                                arg0=DEVICE, path_keyword="path")
+        # bluetoothd restarted, it won't tell what went away
+        bus.watch_name_owner(BLUEZ, lambda owner: owner and self.refresh())
+
+    def refresh(self) -> None:
+        """Reads the whole device tree again"""
+        try:
+            objects = self.bluez.objects()
+        except dbus.exceptions.DBusException as e:
+            print(f"Can't list bluetooth devices: {e}")
+            return
+        now = time.monotonic()
+        with self.lock:
+            known = self.props
+            self.props = {str(path): dict(ifaces[DEVICE]) for path, ifaces in objects.items() if DEVICE in ifaces}
+            # BlueZ still lists it, so it hasn't aged out there either
+            self.seen = {path: now for path in self.props}
+            self.refreshed = now
+            gone = [(path, props) for path, props in known.items() if path not in self.props]
+            current = list(self.props.items())
+        for path, props in gone:
+            self.notify(path, props, False)
+        for path, props in current:
+            self.notify(path, props)
+
+    def on_added(self, path, ifaces) -> None:
+        if DEVICE in ifaces:
+            with self.lock:
+                self.props[str(path)] = props = dict(ifaces[DEVICE])
+                self.seen[str(path)] = time.monotonic()
+            self.notify(path, props)
+
+    def on_removed(self, path, ifaces) -> None:
+        if DEVICE in ifaces:
+            with self.lock:
+                props = self.props.pop(str(path), None)
+                self.seen.pop(str(path), None)
+            if props is not None:
+                self.notify(path, props, False)
+
+    def on_changed(self, interface, changed, invalidated, path=None) -> None:
+        with self.lock:
+            props = self.props.get(str(path))
+            if props is None:
+                return
+            props.update(changed)
+            for name in invalidated:
+                props.pop(name, None)
+            if "RSSI" in changed or changed.get("Connected"):
+                self.seen[str(path)] = time.monotonic()
+            props = dict(props)
+        self.notify(path, props)
+
+    def watch(self, callback) -> None:
+        """`callback` gets every device that changes like `BlueZ.describe` returns it, and whether it's still known"""
+        self.watchers.append(callback)
+
+    def notify(self, path, props, present=True) -> None:
+        device = BlueZ.describe(path, props)
+        for callback in self.watchers:
+            try:
+                callback(device, present)
+            except Exception as e:
+                print(f"Device watcher failed: {e}")
+
+    def devices(self, paired=None) -> list:
+        """Known devices like `BlueZ.devices`, the closest (strongest signal) first"""
+        now = time.monotonic()
+        if self.refreshed is None or not self.live and now - self.refreshed >= self.pollInterval:
+            self.refresh()
+        with self.lock:
+            for path in [p for p, props in self.props.items()
+                         if not props.get("Paired") and not props.get("Connected")
+                         and now - self.seen.get(p, now) > self.maxAge]:
+                del self.props[path]
+                del self.seen[path]
+            found = [BlueZ.describe(path, props) for path, props in self.props.items()]
+        if paired is not None:
+            found = [d for d in found if d["paired"] == paired]
+        # devices out of range have no RSSI, they go last
+        return sorted(found, key=lambda d: -d["rssi"] if d["rssi"] is not None else float("inf"))
+
+    def get(self, mac):
+        """A single device, or None if it isn't known"""
+        path = self.bluez.device_path(mac)
+        with self.lock:
+            props = self.props.get(path)
+            return BlueZ.describe(path, props) if props is not None else None
+
 
 # try to do the dirty work
 
+SPEAKER = "D8:37:3B:0E:9D:C5"
+
+# one layer of the bluetooth audio stack, `probe` says if it works and `repair` brings it back
+Layer = namedtuple("Layer", "name probe repair share")
+
+
+def wait_for(condition, timeout, interval=0.25) -> bool:
+    """Polls `condition` until it's true, returns False if it wasn't within `timeout` seconds"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def pactl(*args):
+    """Output of a pactl command, None if PulseAudio isn't answering"""
+    try:
+        return check_output(["pactl", *args], stderr=DEVNULL).decode()
+    except (CalledProcessError, OSError):
+        return None
+
+
 class BTHack:
-    def initiate(self, hack_only=False, shouldYield=False):
-        #print("Checking cards . . .\n")
-        #status = self.check_refusal()
-        #if not status: return False
-        #elif status != None:
-            # first thing to uncomment if this doesnt work
-        print("Killing PulseAudio . . .\n")
-        try: check_output(["pulseaudio", "-k"], stderr=DEVNULL)
-        except CalledProcessError: pass
-        else: time.sleep(2)
-        if shouldYield: yield 15
-        #check_output(["pulseaudio", "--start"])
-        #time.sleep(2)
-        print("Restarting services . . .\n")
-        check_output("sudo service dbus restart".split(' '))
-        check_output("sudo service bluetooth restart".split(' '))
-        time.sleep(2)
-        if shouldYield: yield 20
-        print("Reviving PulseAudio . . .")
-        check_output(["pulseaudio", "--start"])
-        if shouldYield: yield 15
-        if not shouldYield:
-            stat = self.check_refusal()
-            if not stat: return False
-        else:
-            for s in self.check_refusal(shouldYield=True): yield s
-        print("Enabling bluetooth . . .\n")
-        check_output("bluetoothctl power on".split(' '))
-        if hack_only: 
-            if shouldYield: yield 100
-            else: return True
-        else:
-            # start looking for speaker connection
-            print(f"Looking for speaker connection . . .")
-            if self.look_for_speaker(4, 5):
-                print("Bluetooth connected!")
-                time.sleep(5)
-                #self.play_tone('/home/pi/skip.wav', 2, 2)
-                #return True
-            else:
-                try: check_output("bluetoothctl connect D8:37:3B:0E:9D:C5".split(' '))
-                except CalledProcessError:
-                    print(f"FAILED TO CONNECT")
-                    return False
-                else:
-                    print("Bluetooth connected!")
-                    time.sleep(5)
-            if os.path.exists('/dev/input/event0'):
-                print(f"Linked succesfully!")
-                self.play_tone('/home/pi/skip.wav', 2, 2)
-                return True
-            else:
-                print(f"Couldn't link, restart the device.")
-                self.check_refusal()
-                self.play_tone('/home/pi/restart.wav', 3, 3)
-                time.sleep(10)
-                con = self.look_for_speaker(6, 10)
-                time.sleep(5)
-                if con and os.path.exists('/dev/input/event0'):
-                    print(f"Linked succesfully!")
-                    self.play_tone('/home/pi/skip.wav', 2, 2)
-                    return True
-                else:
-                    print(f"\nFAILED TO LINK")
-                    return False
-        #else: return True
-    def check_bt_info(self, mac):
-        for i in range(6):
-            info = check_output(f'bluetoothctl info {mac}'.split(' ')).decode().replace('\t','').split('\n')
-            if 'Connected: yes' in info: return True
-            time.sleep(10)
-        return False
-    def look_for_speaker(self, times, pause):
-        for i in range(times):
-            try: result = check_output("pactl list cards short".split(' ')).decode()
-            except CalledProcessError: return False
-            else:
-                if "bluez_card" in result: return True
-                time.sleep(pause)
+    """
+    Gets bluetooth audio going, from the system bus up to the speaker.
+
+    The layers are probed bottom up: D-Bus, bluetoothd, PulseAudio with its
+    bluetooth module and finally the link to the speaker. Only a layer that
+    fails its probe gets restarted, plus the ones that lose their connection
+    with it, and every restart waits until the layer is ready instead of
+    sleeping for a fixed time. On a healthy boot nothing gets restarted.
+
+    Attributes:
+        `bluez`     The `BlueZ` client\n
+        `speaker`   MAC address of the speaker\n
+        `timeout`   Seconds a restarted layer gets to come up\n
+        `repaired`  Names of the layers the last recovery had to repair
+    """
+
+    def __init__(self, bluez=None, speaker=SPEAKER, timeout=20):
+        self.bluez = bluez or BlueZ.shared()
+        self.speaker = speaker
+        self.timeout = timeout
+        self.repaired = []
+        self.layers = [Layer("D-Bus", self.bus_ok, self.restart_bus, 15),
+                       Layer("Bluetooth", self.bluetoothd_ok, self.restart_bluetoothd, 30),
+                       Layer("PulseAudio", self.pulse_ok, self.restart_pulse, 30),
+                       Layer("Speaker", self.speaker_ok, self.connect_speaker, 25)]
+
+    def recover(self, speaker=True):
+        """
+        Probes every layer and repairs the broken ones, yields `(increment, phase)`
+        for the progress bar. The increments add up to 100 if everything works,
+        the last layer (the speaker) is left out unless `speaker` is set
+        """
+        layers = self.layers if speaker else self.layers[:-1]
+        total = sum(layer.share for layer in layers[:-1])
+        self.repaired = []
+        for layer in layers:
+            share = layer.share if layer is not layers[-1] else 100 - total
+            # a restarted bus takes the connections of everything above it along
+            if "D-Bus" not in self.repaired and layer.probe():
+                yield share, f"{layer.name} ok"
+                continue
+            print(f"Repairing {layer.name} . . .")
+            yield share // 2, f"Fixing {layer.name}"
+            if not layer.repair():
+                print(f"{layer.name} didn't come back")
+                return
+            self.repaired.append(layer.name)
+            yield share - share // 2, f"{layer.name} ok"
+
+    def initiate(self, speaker=True) -> bool:
+        """Runs a whole recovery, returns whether everything works"""
+        progress = 0
+        for increment, phase in self.recover(speaker):
+            progress += increment
+        if progress < 100:
+            return False
+        if speaker:
+            print("Linked succesfully!")
+            self.play_tone('/home/pi/skip.wav', 1, 0)
+        return True
+
+    # probes
+
+    def bus_ok(self) -> bool:
+        try:
+            self.bluez.running()
+        except dbus.exceptions.DBusException:
+            return False
+        return True
+
+    def bluetoothd_ok(self) -> bool:
+        try:
+            return self.bluez.running() and self.bluez.powered()
+        except dbus.exceptions.DBusException:
+            return False
+
+    def pulse_ok(self) -> bool:
+        modules = pactl("list", "modules", "short")
+        return modules is not None and "module-bluetooth-discover" in modules
+
+    def card_ok(self) -> bool:
+        cards = pactl("list", "cards", "short")
+        return cards is not None and "bluez_card" in cards
+
+    def speaker_ok(self) -> bool:
+        return self.bluez.is_connected(self.speaker) and self.card_ok()
+
+    # repairs, each returns once its layer is ready or it gave up
+
+    def restart_bus(self) -> bool:
+        print("Restarting D-Bus . . .")
+        try:
+            check_output("sudo service dbus restart".split(' '), stderr=DEVNULL)
+        except CalledProcessError:
+            return False
+        return wait_for(self.bus_ok, self.timeout)
+
+    def restart_bluetoothd(self) -> bool:
+        try:
+            running = self.bluez.running()
+        except dbus.exceptions.DBusException:
+            running = False
+        if not running or "D-Bus" in self.repaired:
+            print("Restarting bluetooth . . .")
+            try:
+                check_output("sudo service bluetooth restart".split(' '), stderr=DEVNULL)
+            except CalledProcessError:
+                return False
+
+        def powered():
+            try:
+                self.bluez.power(True)
+                return self.bluez.powered()
+            except dbus.exceptions.DBusException:
+                return False  # the adapter isn't registered yet
+        print("Enabling bluetooth . . .")
+        return wait_for(powered, self.timeout)
+
+    def restart_pulse(self) -> bool:
+        if pactl("info") is None or "D-Bus" in self.repaired:
+            print("Restarting PulseAudio . . .")
+            try:
+                check_output(["pulseaudio", "-k"], stderr=DEVNULL)
+            except (CalledProcessError, OSError):
+                pass  # it wasn't running
+            # it's gone once it stops answering
+            wait_for(lambda: pactl("info") is None, self.timeout)
+            try:
+                check_output(["pulseaudio", "--start"], stderr=DEVNULL)
+            except (CalledProcessError, OSError):
+                return False
+            if not wait_for(lambda: pactl("info") is not None, self.timeout):
+                return False
+        if not self.pulse_ok():
+            print("Loading the bluetooth module . . .")
+            pactl("load-module", "module-bluetooth-discover")
+        return self.pulse_ok()
+
+    def connect_speaker(self) -> bool:
+        print("Looking for speaker connection . . .")
+        if not self.bluez.is_connected(self.speaker):
+            try:
+                self.bluez.connect(self.speaker)
+            except dbus.exceptions.DBusException as e:
+                print(f"FAILED TO CONNECT: {e}")
+                return False
+        # PulseAudio picks the speaker up a moment after it connects
+        return wait_for(self.card_ok, self.timeout)
+
     def play_tone(self, tone, times, pause):
         for i in range(times):
             os.system(f"paplay {tone}")
             time.sleep(pause)
-    def check_refusal(self, messy=False, shouldYield=False):
-        maxAttempts = 3
-        if messy:
-            try: check_output(["pulseaudio", "-k"], stderr=DEVNULL)
-            except CalledProcessError: pass
-            else: time.sleep(2)
-            check_output(["pulseaudio", "--start"], stderr=DEVNULL)
-        else:
-            while True:
-                try: check_output("pactl list cards short".split(' '), stderr=DEVNULL).decode()
-                except CalledProcessError:
-                    maxAttempts -= 1
-                    if maxAttempts <= 0: return False
-                    # stupid initialization, restart
-                    print("Killing PulseAudio . . .")
-                    try: check_output(["pulseaudio", "-k"], stderr=DEVNULL)
-                    except CalledProcessError: pass
-                    else: time.sleep(2)
-                    if shouldYield: yield 5
-                    print("Reviving PulseAudio . . .")
-                    check_output(["pulseaudio", "--start"])
-                    time.sleep(2)
-                    if shouldYield: yield 5
-                else:
-                    if not shouldYield: return True
-                    else:
-                        yield 10
-                        break
\ No newline at end of file
@@ -0,0 +1,81 @@
+import time
+import threading
+
+
+class BootProgress:
+    """
+    What's still coming up after the menu is on the screen.
+
+    The library scan and the bluetooth bring-up run side by side in the
+    background, each as a named stage reporting a short status from its own
+    thread, so the menu can show how far along they are and enable the music
+    entries once the stages they need are ready. Milestones like the first
+    frame and the first sound are logged once, in seconds since `started`.
+
+    Attributes:
+        `started`       Monotonic time the boot started\n
+        `onChange`      Optional callback run whenever a stage reports progress
+    """
+
+    def __init__(self, started=None, onChange=None):
+        self.started = time.monotonic() if started is None else started
+        self.onChange = onChange
+        self.lock = threading.Lock()
+        self.stages = {}  # name -> status text, in the order they were started
+        self.ready = {}  # name -> Event set once the stage is done
+        self.marks = {}  # milestone -> seconds since boot
+
+    def stage(self, name, status="starting") -> None:
+        with self.lock:
+            self.stages[name] = status
+            self.ready.setdefault(name, threading.Event())
+        self.changed()
+
+    def update(self, name, status) -> None:
+        with self.lock:
+            if self.ready[name].is_set():
+                return
+            self.stages[name] = status
+        self.changed()
+
+    def finish(self, name, ok=True) -> None:
+        with self.lock:
+            if self.ready[name].is_set():
+                return
+            self.stages[name] = "ready" if ok else "failed"
+            self.ready[name].set()
+        self.mark(f"{name} {self.stages[name]}")
+        self.changed()
+        if all(event.is_set() for event in self.ready.values()):
+            print(f"Boot: {self.report()}")
+
+    def changed(self) -> None:
+        if self.onChange:
+            self.onChange()
+
+    def is_ready(self, name) -> bool:
+        event = self.ready.get(name)
+        return event is not None and event.is_set()
+
+    def wait(self, name, timeout=None) -> bool:
+        with self.lock:
+            event = self.ready.setdefault(name, threading.Event())
+        return event.wait(timeout)
+
+    def mark(self, milestone) -> None:
+        """Logs the first time `milestone` is reached"""
+        with self.lock:
+            if milestone in self.marks:
+                return
+            self.marks[milestone] = elapsed = time.monotonic() - self.started
+        print(f"Boot: {milestone} after {elapsed:.2f}s")
+
+    def status(self) -> str:
+        """Short line with the stages still running, empty once all are done"""
+        with self.lock:
+            return ", ".join(f"{name} {status}" for name, status in self.stages.items()
+                             if not self.ready[name].is_set())
+
+    def report(self) -> str:
+        with self.lock:
+            return ", ".join(f"{milestone} {seconds:.2f}s" for milestone, seconds in self.marks.items())
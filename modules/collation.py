@@ -0,0 +1,114 @@
+import bisect
+import threading
+import unicodedata
+
+# jump targets, everything that doesn't start with a letter is filed under "#"
+LETTERS = "#ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def collation_key(label) -> str:
+    """Sort key ignoring case, accents and leading punctuation, so "Émile" sits with the E's"""
+    text = str(label)
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(c for c in text if not unicodedata.combining(c))
+    text = text.casefold()
+    stripped = text.lstrip(" \t.,'\"([{-_!?¡¿*")
+    return stripped or text
+
+
+def letter_of(key) -> str:
+    first = key[:1].upper()
+    return first if "A" <= first <= "Z" else "#"
+
+
+def sort_key(label) -> tuple:
+    # the "#" group goes first even when it starts with a symbol that sorts after "z"
+    key = collation_key(label)
+    return (0 if letter_of(key) == "#" else 1, key)
+
+
+class CollationIndex:
+    """
+    Items kept in alphabetical order as they come and go, with the position where
+    every first letter starts, so the sorted view of a long list is built once and
+    jumping to a letter is a binary search.
+
+    Attributes:
+        `label`         Callback returning the text an item is sorted by
+    """
+
+    def __init__(self, items=(), label=str):
+        self.label = label
+        self.lock = threading.Lock()
+        self.keys = {}  # item -> sort key
+        for item in items:
+            self.keys[item] = sort_key(label(item))
+        ordered = sorted(self.keys.items(), key=lambda pair: pair[1])
+        self.sortKeys = [key for _, key in ordered]
+        self.items = [item for item, _ in ordered]
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __getitem__(self, i):
+        return self.items[i]
+
+    def __contains__(self, item) -> bool:
+        return item in self.keys
+
+    def add(self, item) -> None:
+        key = sort_key(self.label(item))
+        with self.lock:
+            if item in self.keys:
+                return
+            self.keys[item] = key
+            i = bisect.bisect_right(self.sortKeys, key)
+            self.sortKeys.insert(i, key)
+            self.items.insert(i, item)
+
+    def remove(self, item) -> None:
+        with self.lock:
+            key = self.keys.pop(item, None)
+            if key is None:
+                return
+            i = bisect.bisect_left(self.sortKeys, key)
+            while self.items[i] != item:
+                i += 1  # items with the same label
+            del self.sortKeys[i]
+            del self.items[i]
+
+    def relabel(self, item) -> None:
+        """The label of an item changed, moves it to its new place"""
+        if item in self.keys and self.keys[item] != sort_key(self.label(item)):
+            self.remove(item)
+            self.add(item)
+
+    def on_change(self, item, added) -> None:
+        """Fits `PlayQueue.onChange`"""
+        if added:
+            self.add(item)
+        else:
+            self.remove(item)
+
+    def first_of(self, letter) -> int:
+        """Position of the first item filed under `letter` or any letter after it"""
+        if letter == "#":
+            return 0
+        with self.lock:
+            return bisect.bisect_left(self.sortKeys, (1, letter.casefold()))
+
+    def letter_at(self, i) -> str:
+        with self.lock:
+            if not self.items:
+                return "#"
+            return letter_of(self.sortKeys[min(i, len(self.items) - 1)][1])
+
+    def letters(self) -> list:
+        """The letters that have at least one item"""
+        found = []
+        for letter in LETTERS:
+            start = self.first_of(letter)
+            if start < len(self) and self.letter_at(start) == letter:
+                found.append(letter)
+        return found
@@ -0,0 +1,294 @@
+import time
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageDraw, ImageFont
+
+SET_PAGE = 0xB0         # + page number
+SET_COLUMN_LOW = 0x00   # | low nibble of the column
+SET_COLUMN_HIGH = 0x10  # | high nibble of the column
+COLUMN_OFFSET = 2       # the 128 visible columns sit in the middle of the SH1106's 132
+
+# pillow packs the top pixel into the high bit, the SH1106 wants it in the low one
+REVERSE_BITS = bytes(int(f"{b:08b}"[::-1], 2) for b in range(256))
+
+# the one font every screen is drawn with
+font = ImageFont.load_default()
+
+
+def pack_pages(image, pages, flip=Image.TRANSPOSE) -> list:
+    """Packs a 1-bit image into the SH1106 page layout, one bytes object of columns per page"""
+    # after transposing, every row of the image is one column of the screen
+    packed = image.transpose(flip).tobytes().translate(REVERSE_BITS)
+    return [packed[page::pages] for page in range(pages)]
+
+
+def changed_span(old, new):
+    """First and last differing byte of two equally long buffers, or None if they match"""
+    diff = int.from_bytes(old, 'big') ^ int.from_bytes(new, 'big')
+    if not diff:
+        return None
+    first = len(new) - (diff.bit_length() + 7) // 8
+    last = len(new) - 1 - ((diff & -diff).bit_length() - 1) // 8
+    return first, last
+
+
+class DiffDisplay:
+    """
+    Sits in front of the SH1106 driver and only sends what changed on the panel.
+
+    The last frame that reached the panel is kept packed the way the controller
+    stores it, 8 pages of 128 columns. A new frame is compared page by page and
+    only the changed column span of each page gets sent over SPI, identical frames
+    aren't sent at all. `canvas` works on it like on the driver, anything else
+    (`contrast`, `show`, `hide`...) is passed through.
+
+    Attributes:
+        `device`            The luma sh1106 device\n
+        `reportInterval`    Seconds between printing the transfer stats (0 to never print)
+    """
+
+    def __init__(self, device, reportInterval=300):
+        self.device = device
+        self.reportInterval = reportInterval
+        self.pages = device.height // 8
+        self.lock = threading.Lock()
+        self.shown = None  # packed pages on the panel, None when unknown
+        self.rendered = 0
+        self.skipped = 0
+        self.bytesSent = 0
+        self.since = time.monotonic()
+        self.reported = self.since
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def display(self, image) -> None:
+        if image.mode != "1":
+            image = image.convert("1")
+        if getattr(self.device, "rotate", 0) == 2:
+            # upside down, turning and transposing is a single flip
+            frame = pack_pages(image, self.pages, Image.TRANSVERSE)
+        else:
+            frame = pack_pages(self.device.preprocess(image), self.pages)
+        with self.lock:
+            sent = 0
+            for page, columns in enumerate(frame):
+                if self.shown is None:
+                    span = (0, len(columns) - 1)
+                else:
+                    span = changed_span(self.shown[page], columns)
+                    if span is None:
+                        continue
+                first, last = span
+                column = first + COLUMN_OFFSET
+                self.device.command(SET_PAGE + page, SET_COLUMN_LOW | column & 0x0F,
+                                    SET_COLUMN_HIGH | column >> 4)
+                self.device.data(list(columns[first:last + 1]))
+                sent += 3 + last - first + 1
+            self.shown = frame
+            if sent:
+                self.rendered += 1
+                self.bytesSent += sent
+            else:
+                self.skipped += 1
+        if self.reportInterval and time.monotonic() - self.reported >= self.reportInterval:
+            print(f"Display: {self.report()}")
+            self.reported = time.monotonic()
+
+    def invalidate(self) -> None:
+        """Forgets the panel contents, the next frame is sent in full"""
+        with self.lock:
+            self.shown = None
+
+    def clear(self) -> None:
+        self.display(Image.new(self.device.mode, self.device.size))
+
+    def stats(self) -> dict:
+        with self.lock:
+            elapsed = time.monotonic() - self.since
+            return {"rendered": self.rendered,
+                    "skipped": self.skipped,
+                    "bytesSent": self.bytesSent,
+                    "bytesPerSecond": self.bytesSent / elapsed if elapsed else 0}
+
+    def report(self) -> str:
+        s = self.stats()
+        return (f"{s['rendered']} frames sent, {s['skipped']} unchanged frames skipped, "
+                f"{s['bytesSent']} bytes ({s['bytesPerSecond']:.0f}/s)")
+
+
+class FrameBuffer:
+    """
+    The one image every screen is drawn into, used in place of luma's `canvas`.
+
+    `canvas` allocates a new image and drawing context for every frame and
+    rasterizes each line of text again. Here the image is cleared and reused,
+    and text lines are rendered once into small bitmaps kept in an LRU cache,
+    so drawing a menu is mostly pasting cached lines. Only one thread can draw
+    at a time, the frame goes to `display` when the `with` block ends.
+
+    Attributes:
+        `display`       Where finished frames are sent, usually the `DiffDisplay`\n
+        `cacheSize`     Number of rendered text lines kept
+    """
+    defaultFont = font
+
+    def __init__(self, display, cacheSize=128):
+        self.display = display
+        self.cacheSize = cacheSize
+        self.image = Image.new("1", display.size)
+        self.draw = ImageDraw.Draw(self.image)
+        self.lines = OrderedDict()  # text -> bitmap, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.image.paste(0, (0, 0) + self.image.size)
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        try:
+            if excType is None:
+                self.display.display(self.image)
+        finally:
+            self.lock.release()
+
+    def __getattr__(self, name):
+        # rectangle, polygon and the rest of ImageDraw
+        return getattr(self.draw, name)
+
+    def text(self, xy, text, font=font, fill=255) -> None:
+        if font is not self.defaultFont or fill != 255:
+            self.draw.text(xy, text, font=font, fill=fill)
+            return
+        line = self.line(text)
+        if line:
+            # the line is only a mask, whatever is drawn around it stays
+            self.image.paste(255, (xy[0], xy[1], xy[0] + line.width, xy[1] + line.height), line)
+
+    def line(self, text):
+        """Rendered bitmap of a line of text, None if it's blank"""
+        if text in self.lines:
+            self.lines.move_to_end(text)
+            self.hits += 1
+            return self.lines[text]
+        self.misses += 1
+        _, _, width, height = self.defaultFont.getbbox(text)
+        line = None
+        if width > 0 and height > 0:
+            line = Image.new("1", (width, height))
+            ImageDraw.Draw(line).text((0, 0), text, font=self.defaultFont, fill=255)
+        self.lines[text] = line
+        if len(self.lines) > self.cacheSize:
+            self.lines.popitem(last=False)
+        return line
+
+
+class FrameScheduler:
+    """
+    The only thing that draws on the screen, every other part just says what should be on it.
+
+    Menus, feeds and progress bars hand over a painter, a function drawing the
+    current screen, and the scheduler renders it on its own thread at most once
+    per frame interval. Requests that come in while a frame is waiting are folded
+    into it, so a burst of updates costs one frame and threads can't draw over
+    each other halfway through a frame.
+
+    Attributes:
+        `frame`         The `FrameBuffer` frames are drawn into\n
+        `fps`           Most frames drawn per second, also sets the frame budget
+    """
+
+    def __init__(self, frame, fps=30):
+        self.frame = frame
+        self.fps = fps
+        self.interval = 1 / fps
+        self.painter = None
+        self.cond = threading.Condition()
+        self.dirty = False
+        self.rendering = False
+        self.lastFrame = 0.0
+        # frame timing
+        self.requests = 0
+        self.frames = 0
+        self.renderTime = 0.0
+        self.maxRender = 0.0
+        self.overBudget = 0
+        self.shouldDie = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def show(self, painter) -> None:
+        """Puts a new screen up, `painter` gets called with the drawing context on the render thread"""
+        with self.cond:
+            self.painter = painter
+            self._mark()
+
+    def mark(self) -> None:
+        """Draws the current screen again, e.g. when the state it shows changed"""
+        with self.cond:
+            if self.painter:
+                self._mark()
+
+    def _mark(self) -> None:
+        self.requests += 1
+        self.dirty = True
+        self.cond.notify_all()
+
+    def flush(self, timeout=1) -> bool:
+        """Waits until the last requested frame is on the screen"""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.dirty and not self.rendering or self.shouldDie,
+                                      timeout)
+
+    def stop(self) -> None:
+        self.flush()
+        with self.cond:
+            self.shouldDie = True
+            self.cond.notify_all()
+
+    def run(self) -> None:
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.dirty or self.shouldDie)
+                if self.shouldDie:
+                    return
+                wait = self.lastFrame + self.interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)  # later requests get folded into this frame
+            with self.cond:
+                painter = self.painter
+                self.dirty = False
+                self.rendering = True
+            started = time.monotonic()
+            try:
+                with self.frame as draw:
+                    painter(draw)
+            except Exception as e:
+                print(f"Can't draw frame: {e}")
+            elapsed = time.monotonic() - started
+            with self.cond:
+                self.rendering = False
+                self.lastFrame = started
+                self.frames += 1
+                self.renderTime += elapsed
+                self.maxRender = max(self.maxRender, elapsed)
+                if elapsed > self.interval:
+                    self.overBudget += 1
+                self.cond.notify_all()
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {"frames": self.frames,
+                    "coalesced": self.requests - self.frames,
+                    "averageRender": self.renderTime / self.frames if self.frames else 0,
+                    "maxRender": self.maxRender,
+                    "overBudget": self.overBudget}
+
+    def report(self) -> str:
+        s = self.stats()
+        return (f"{s['frames']} frames drawn, {s['coalesced']} requests coalesced, "
+                f"{s['averageRender'] * 1000:.1f} ms average and {s['maxRender'] * 1000:.1f} ms max render, "
+                f"{s['overBudget']} over the {self.interval * 1000:.0f} ms budget")
@@ -1,8 +1,9 @@
-from luma.core.render import canvas
-import RPi.GPIO as GPIO
-import time
 import json
-from PIL import ImageFont
+from functools import partial
+
+from modules.keypad import REDRAW, RELEASED
+from modules.display import font
+from modules.collation import CollationIndex
 
 KEY_UP_PIN = 6  # stick up
 KEY_DOWN_PIN = 19  # stick down
@@ -13,8 +14,6 @@ KEY1_PIN = 21  # key 1 // up
 KEY2_PIN = 20  # key 2
 KEY3_PIN = 16  # key 3 // down
 
-font = ImageFont.load_default()
-
 
 class Element():
     def __init__(self):
@@ -158,47 +157,23 @@ class Slider(Element):
         return self.title
 
     def activate(self):
-        shouldRefresh = True
+        key = REDRAW
         # self.device.clear()
-        while shouldRefresh:
-            self.device.contrast(round(255 * (self.value/100)))
-            time.sleep(0.5)
-            while GPIO.input(KEY_PRESS_PIN):
-                with canvas(self.device) as draw:
-                    draw.text(
-                        (0, -2), "Set the brightness",  font=font, fill=255)
-                    draw.rectangle(((14, 28), (114, 36)), outline=255, fill=0)
-                    if not GPIO.input(KEY_LEFT_PIN):
-                        if self.value >= 5:
-                            self.value -= 5
-                            self.device.contrast(
-                                round(255 * (self.value/100)))
-                            print(f"Brightness: {self.value}%")
-                            draw.polygon(
-                                [(2, 32), (11, 27), (11, 37)], outline=255, fill=255)
-                        shouldRefresh = True
-                        # break
-                    else:
-                        if self.value > 0:
-                            draw.polygon(
-                                [(2, 32), (11, 27), (11, 37)], outline=255, fill=0)
-                    if not GPIO.input(KEY_RIGHT_PIN):
-                        if self.value < 100:
-                            self.value += 5
-                            self.device.contrast(
-                                round(255 * (self.value/100)))
-                            print(f"Brightness: {self.value}%")
-                            draw.polygon(
-                                [(117, 27), (117, 37), (126, 32)], outline=255, fill=255)
-                        shouldRefresh = True
-                        # break
-                    else:
-                        if self.value < 100:
-                            draw.polygon(
-                                [(117, 27), (117, 37), (126, 32)], outline=255, fill=0)
-                    draw.rectangle(
-                        ((14, 28), (14 + round(100 * (self.value/100)), 36)), outline=255, fill=255)
-            shouldRefresh = False
+        self.device.contrast(round(255 * (self.value/100)))
+        while key != KEY_PRESS_PIN:
+            lit = None  # arrow of the step just taken
+            if key == KEY_LEFT_PIN and self.value >= 5:
+                self.value -= 5
+                lit = key
+            elif key == KEY_RIGHT_PIN and self.value < 100:
+                self.value += 5
+                lit = key
+            if lit:
+                self.device.contrast(round(255 * (self.value/100)))
+                print(f"Brightness: {self.value}%")
+            # the pressed arrow stays lit until the next key
+            self.master.screen.show(partial(self.draw, self.value, lit))
+            key = self.master.keypad.wait(repeat=(KEY_LEFT_PIN, KEY_RIGHT_PIN))
         if self.value != self.master.settings["brightness"]:
             # save changes
             self.master.brightness = self.value
@@ -210,6 +185,25 @@ class Slider(Element):
             self.onExit()
         return True
 
+    def draw(self, value, lit, draw) -> None:
+        draw.text(
+            (0, -2), "Set the brightness",  font=font, fill=255)
+        draw.rectangle(((14, 28), (114, 36)), outline=255, fill=0)
+        if lit == KEY_LEFT_PIN:
+            draw.polygon(
+                [(2, 32), (11, 27), (11, 37)], outline=255, fill=255)
+        elif value > 0:
+            draw.polygon(
+                [(2, 32), (11, 27), (11, 37)], outline=255, fill=0)
+        if lit == KEY_RIGHT_PIN:
+            draw.polygon(
+                [(117, 27), (117, 37), (126, 32)], outline=255, fill=255)
+        elif value < 100:
+            draw.polygon(
+                [(117, 27), (117, 37), (126, 32)], outline=255, fill=0)
+        draw.rectangle(
+            ((14, 28), (14 + round(100 * (value/100)), 36)), outline=255, fill=255)
+
 
 class Prompt(Element):
     """
@@ -236,9 +230,11 @@ class Prompt(Element):
         while shouldRefresh:
             self.master.DisplayText(
                 ["Are you sure?", "  Yes", "  No"], optSelect)
-            time.sleep(0.5)
             while True:
-                if not GPIO.input(KEY_UP_PIN):
+                key = self.master.keypad.wait(repeat=(KEY_UP_PIN, KEY_DOWN_PIN))
+                if key == REDRAW:
+                    break
+                elif key == KEY_UP_PIN:
                     if optSelect == self.select_range[0]:
                         if len(self.select_range) > 1:
                             optSelect = self.select_range[1]
@@ -247,22 +243,82 @@ class Prompt(Element):
                     else:
                         optSelect -= 1
                     break
-                elif not GPIO.input(KEY_DOWN_PIN):
+                elif key == KEY_DOWN_PIN:
                     if optSelect == 2 or len(self.select_range) > 1 and optSelect == self.select_range[1]:
                         optSelect = self.select_range[0]
                     else:
                         optSelect += 1
                     break
-                elif not GPIO.input(KEY_RIGHT_PIN):
+                elif key == KEY_RIGHT_PIN:
                     if optSelect == 1 and self.confirmAction:
                         self.confirmAction()
+                        self.master.keypad.clear()
                     return True
-                elif not GPIO.input(KEY_LEFT_PIN):
+                elif key == KEY_LEFT_PIN:
                     shouldRefresh = False
                     break
         return True  # for Menu to close prompt
 
 
+class ListModel():
+    """
+    Rows of a paginated `Menu` that only turn into elements once their page is shown,
+    so a long list like the queue never exists as elements all at once.
+
+    Attributes:
+        `length`        Callback returning the current number of rows\n
+        `build`         Callback turning a row index into a menu element\n
+        `sorter`        Optional callback returning the rows sorted alphabetically, as another `ListModel`\n
+        `index`         Optional `CollationIndex` the rows are read from, allows jumping to a letter
+    """
+
+    def __init__(self, length, build, sorter=None, index=None):
+        self.length = length
+        self.build = build
+        self.sorter = sorter
+        self.index = index
+
+    @classmethod
+    def of(cls, options):
+        """Wraps a plain list of elements"""
+        return cls(options.__len__, options.__getitem__, lambda: cls.collated(options))
+
+    @classmethod
+    def collated(cls, options):
+        index = CollationIndex(options, str)
+        return cls(index.__len__, index.__getitem__, index=index)
+
+    def __len__(self):
+        return self.length()
+
+    def page_count(self, pageLength) -> int:
+        return (len(self) + pageLength - 1) // pageLength
+
+    def page(self, index, pageLength) -> list:
+        rows = []
+        for i in range(index * pageLength, min((index + 1) * pageLength, len(self))):
+            try:
+                rows.append(self.build(i))
+            except IndexError:
+                break  # the list got shorter while the page was built
+        return rows
+
+    def sorted(self):
+        return self.sorter() if self.sorter else self
+
+    def jump(self, position, step) -> int:
+        """Row where the next (`step` 1) or previous (-1) letter starts, counted from `position`"""
+        letters = self.index.letters() if self.index else []
+        if not letters:
+            return position
+        current = self.index.letter_at(position)
+        if current in letters:
+            target = letters[(letters.index(current) + step) % len(letters)]
+        else:
+            target = letters[0]
+        return self.index.first_of(target)
+
+
 class Menu(Element):
     """
     Primary element for the main menu, can also be used to create nested submenus.
@@ -274,8 +330,10 @@ class Menu(Element):
         `select_range`  Tuple of indexes defining boundaries of menu list element selection\n
         `updater`       Optional callback function to dynamically load-in list of menu elements\n
         `update_again`  Whether or not `updater` should be called again after selecting a menu element\n
-        `paginate`      Whether or not `updater` element list should be split into chunks for cyclable pages\n
-        `sortable`      Whether or not the paginated element list can be sorted alphabetically by pressing key2/button2.\n
+        `paginate`      Whether or not `updater` element list should be split into chunks for cyclable pages.
+        `updater` may also return a `ListModel` so only the page on screen gets built\n
+        `sortable`      Whether or not the paginated element list can be sorted alphabetically by pressing key2/button2.
+        Holding key2/button2 and moving the stick up or down jumps between first letters\n
         `submenu`       Whether or not this menu exists inside of another menu\n
         `autoclose`     Whether or not this menu should close itself after selecting a menu element (if submenu)\n
         `btn1`          Optional callback function to execute when key1/button1 is pressed\n
@@ -315,22 +373,33 @@ class Menu(Element):
             if self.updater:
                 self.options.extend(self.updater())
         initialized = False
+        redrawOnly = False  # woken up by something other than a key, keep the list
         optionIndex = self.select_range[0]
 
         shouldRefresh = True
 
+        # keys that keep scrolling while held, the others only act once per press
+        repeatKeys = [KEY_UP_PIN, KEY_DOWN_PIN]
+        if self.paginate and not self.btn1:
+            repeatKeys.append(KEY1_PIN)
+        if self.paginate and not self.btn3:
+            repeatKeys.append(KEY3_PIN)
+        # key2 sorts when tapped, held down it turns the stick into a letter jump
+        letterJump = self.paginate and self.sortable and not self.btn2
+        releaseKeys = [KEY2_PIN] if letterJump else []
+        jumped = False
+
         pageIndex = 0
         alphabetical = False
-        resorted = True
+        sortedRows = None  # alphabetical view, made the first time it's asked for
 
-        def refresh_pages():
-            return [self.options[i * pageLength:(i + 1) * pageLength]
-                    for i in range((len(self.options) + pageLength - 1) // pageLength)]
+        def as_model(options):
+            return options if isinstance(options, ListModel) else ListModel.of(options)
         if self.paginate:
             pageLength = 7  # number of songs to fit in one "page"
-            pages = refresh_pages()
+            rows = as_model(self.options)
         while shouldRefresh:
-            if self.update_again and initialized and not self.paginate:
+            if self.update_again and initialized and not redrawOnly and not self.paginate:
                 if self.updater:
                     self.options = self.updater()
                     initialized = False
@@ -339,19 +408,38 @@ class Menu(Element):
                 self.master.DisplayText([str(option)
                                         for option in self.options], optionIndex)
             else:
-                if not resorted:
-                    if alphabetical:
-                        opts = sorted(self.options, key=str)
-                    else:
-                        opts = self.options
-                    pages = [opts[i * pageLength:(i + 1) * pageLength]
-                             for i in range((len(self.options) + pageLength - 1) // pageLength)]
-                    resorted = True
-                self.master.DisplayText([str(f)
-                                         for f in pages[pageIndex] if True], optionIndex)
-            time.sleep(0.5)
+                if alphabetical and sortedRows is None:
+                    sortedRows = rows.sorted()
+                view = sortedRows if alphabetical else rows
+                # the rows are built fresh on every draw, the list may have changed underneath
+                pageCount = view.page_count(pageLength)
+                pageIndex = max(min(pageIndex, pageCount - 1), 0)
+                page = view.page(pageIndex, pageLength)
+                optionIndex = max(min(optionIndex, len(page) - 1), self.select_range[0])
+                lines = [str(f) for f in page if True]
+                if jumped and page and view.index:
+                    # the letter sits next to the cursor while key2 is held
+                    letter = view.index.letter_at(pageIndex * pageLength + optionIndex)
+                    lines[optionIndex] = f"{letter}>{lines[optionIndex][2:]}"
+                    self.master.DisplayText(lines)
+                else:
+                    self.master.DisplayText(lines, optionIndex)
             while True:
-                if not GPIO.input(KEY_UP_PIN):
+                key = self.master.keypad.wait(repeat=repeatKeys, release=releaseKeys)
+                redrawOnly = key == REDRAW
+                if redrawOnly:
+                    break
+                elif key in (KEY_UP_PIN, KEY_DOWN_PIN) and letterJump and self.master.keypad.is_pressed(KEY2_PIN):
+                    if not alphabetical:
+                        alphabetical = True
+                        if sortedRows is None:
+                            sortedRows = rows.sorted()
+                    position = sortedRows.jump(pageIndex * pageLength + optionIndex,
+                                               -1 if key == KEY_UP_PIN else 1)
+                    pageIndex, optionIndex = divmod(position, pageLength)
+                    jumped = True
+                    break
+                elif key == KEY_UP_PIN:
                     if optionIndex == self.select_range[0]:
                         if len(self.select_range) > 1:
                             optionIndex = self.select_range[1]
@@ -359,18 +447,20 @@ class Menu(Element):
                             if not self.paginate:
                                 optionIndex = len(self.options) - 1
                             else:
-                                optionIndex = len(pages[pageIndex]) - 1
+                                optionIndex = len(page) - 1
                     else:
                         optionIndex -= 1
                     break
-                elif not GPIO.input(KEY_DOWN_PIN):
-                    if self.paginate and len(pages[pageIndex]) - 1 == optionIndex or optionIndex == (len(self.options) - 1) or len(self.select_range) > 1 and optionIndex == self.select_range[1]:
+                elif key == KEY_DOWN_PIN:
+                    if self.paginate and len(page) - 1 == optionIndex or optionIndex == (len(self.options) - 1) or len(self.select_range) > 1 and optionIndex == self.select_range[1]:
                         optionIndex = self.select_range[0]
                     else:
                         optionIndex += 1
                     break
-                elif not GPIO.input(KEY_RIGHT_PIN):
-                    if not self.paginate and self.options[optionIndex].activate() or self.paginate and pages[pageIndex][optionIndex].activate():
+                elif key == KEY_RIGHT_PIN:
+                    activated = not self.paginate and self.options[optionIndex].activate() or self.paginate and page and page[optionIndex].activate()
+                    self.master.keypad.clear()  # presses made while the element had the screen
+                    if activated:
                         # if self.dismissable and self.submenu:
                         if self.submenu:
                             if not self.paginate and self.autoclose:
@@ -378,31 +468,36 @@ class Menu(Element):
                             elif self.paginate and self.update_again and self.updater:
                                 print("rerender queue")
                                 self.options = self.updater()  # refresh menu list after selected element closes
-                                pages = refresh_pages()
+                                rows = as_model(self.options)
+                                sortedRows = None
                         break
-                elif not GPIO.input(KEY_LEFT_PIN):
+                elif key == KEY_LEFT_PIN:
                     if self.submenu:
                         shouldRefresh = False
                         break
-                elif not GPIO.input(KEY1_PIN):
+                elif key == KEY1_PIN:
                     if self.btn1:
                         self.btn1()
                     elif self.paginate:
                         if pageIndex > 0:
                             pageIndex -= 1
                             break
-                elif not GPIO.input(KEY2_PIN):
+                elif key == KEY2_PIN:
                     if self.btn2:
                         self.btn2()
-                    elif self.paginate and self.sortable:
+                    else:
+                        jumped = False
+                elif key == RELEASED + KEY2_PIN:
+                    if not jumped:
+                        # both views stay around, switching back and forth is free
                         alphabetical = not alphabetical
-                        resorted = False
-                        break
-                elif not GPIO.input(KEY3_PIN):
+                    jumped = False
+                    break
+                elif key == KEY3_PIN:
                     if self.btn3:
                         self.btn3()
                     elif self.paginate:
-                        if pageIndex < len(pages) - 1:
+                        if pageIndex < pageCount - 1:
                             pageIndex += 1
                         break
             initialized = True
@@ -0,0 +1,143 @@
+import time
+import ctypes
+import platform
+import threading
+
+# syscall numbers per architecture, Python 3.7 has no portable way to get a thread id
+SYS_GETTID = {"x86_64": 186, "aarch64": 178, "armv6l": 224, "armv7l": 224}
+SYS_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "armv6l": 314, "armv7l": 314}
+IOPRIO_WHO_PROCESS = 1  # a single thread when given a thread id
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+class IOScheduler:
+    """
+    Keeps library scans and metadata reads out of the way of the track that is playing.
+
+    Worker threads are moved to the idle I/O class, so the kernel only serves them
+    when omxplayer isn't reading. Directory listings and tag reads also take a token
+    from a bucket refilled at `rate` per second, and wait while playback looks like
+    it is starving, i.e. the player position moves slower than the clock.
+
+    Attributes:
+        `rate`          Reads per second allowed on average (0 for no limit)\n
+        `burst`         Reads allowed back to back before the rate kicks in\n
+        `idle`          Whether worker threads get the idle I/O class\n
+        `probe`         Callback returning the playback position in seconds, or None
+        when nothing is playing. Set by the music player\n
+        `maxStall`      Longest a read waits for playback to recover
+    """
+
+    def __init__(self, rate=50, burst=10, idle=True, maxStall=10):
+        self.rate = rate
+        self.burst = burst
+        self.idle = idle
+        self.maxStall = maxStall
+        self.probe = None
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.lock = threading.Lock()
+        self.libc = None
+        # last probe sample, (clock, position)
+        self.sample = None
+        self.lagging = False
+        # counters for tuning the throttle
+        self.reads = 0
+        self.throttled = 0
+        self.throttleTime = 0.0
+        self.stalls = 0
+        self.stallTime = 0.0
+        self.active = 0.0  # seconds spent in bursts of reads, idle gaps left out
+        self.lastRead = None
+
+    def worker_init(self) -> None:
+        """Thread pool initializer, drops the calling thread into the idle I/O class"""
+        if not self.idle:
+            return
+        machine = platform.machine()
+        if machine not in SYS_IOPRIO_SET:
+            return
+        try:
+            if self.libc is None:
+                self.libc = ctypes.CDLL(None, use_errno=True)
+            tid = self.libc.syscall(SYS_GETTID[machine])
+            prio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+            if self.libc.syscall(SYS_IOPRIO_SET[machine], IOPRIO_WHO_PROCESS, tid, prio) < 0:
+                raise OSError(ctypes.get_errno(), "ioprio_set failed")
+        except OSError as e:
+            print(f"Can't lower the I/O priority of scan workers: {e}")
+            self.idle = False
+
+    def acquire(self) -> None:
+        """Blocks until the next read is allowed"""
+        self.wait_for_playback()
+        with self.lock:
+            now = time.monotonic()
+            if self.lastRead is not None and now - self.lastRead < 1:
+                self.active += now - self.lastRead
+            self.lastRead = now
+            self.reads += 1
+            if self.rate <= 0:
+                return
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            self.tokens -= 1
+            # a negative balance is the wait this read owes, queued behind the others
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            if wait:
+                self.throttled += 1
+                self.throttleTime += wait
+        if wait:
+            time.sleep(wait)
+
+    def wait_for_playback(self) -> None:
+        stalled = 0.0
+        while self.check_lagging() and stalled < self.maxStall:
+            if not stalled:
+                with self.lock:
+                    self.stalls += 1
+            time.sleep(0.5)
+            stalled += 0.5
+        if stalled:
+            with self.lock:
+                self.stallTime += stalled
+
+    def check_lagging(self) -> bool:
+        """Samples the player at most once a second, lagging if its position falls behind the clock"""
+        probe = self.probe
+        if not probe:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if self.sample and now - self.sample[0] < 1:
+                return self.lagging
+            try:
+                position = probe()
+            except Exception:
+                position = None
+            if position is None:
+                self.sample = None
+                self.lagging = False
+            else:
+                if self.sample:
+                    # going backwards means a new track started, not a stutter
+                    moved = position - self.sample[1]
+                    self.lagging = 0 <= moved < (now - self.sample[0]) * 0.9
+                self.sample = (now, position)
+            return self.lagging
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"reads": self.reads,
+                    "readsPerSecond": self.reads / self.active if self.active else 0,
+                    "throttled": self.throttled,
+                    "throttleTime": self.throttleTime,
+                    "stalls": self.stalls,
+                    "stallTime": self.stallTime}
+
+    def report(self) -> str:
+        s = self.stats()
+        return (f"{s['reads']} reads ({s['readsPerSecond']:.1f}/s), "
+                f"{s['throttled']} throttled for {s['throttleTime']:.1f}s, "
+                f"{s['stalls']} stalls for {s['stallTime']:.1f}s behind playback")
@@ -0,0 +1,153 @@
+import time
+import queue
+import threading
+from collections import namedtuple
+import RPi.GPIO as GPIO
+
+# pseudo key asking the active element to draw itself again
+REDRAW = -1
+# added to a pin to report it being let go, see `Keypad.wait`
+RELEASED = 1000
+
+PRESS = "press"
+RELEASE = "release"
+REPEAT = "repeat"
+
+KeyEvent = namedtuple("KeyEvent", "pin kind time")
+
+
+class Keypad:
+    """
+    Collects the HAT's key presses from GPIO edge interrupts into one queue,
+    so the menus sleep until something happens instead of polling the pins.
+
+    Both edges are watched and debounced on their timestamps, giving press and
+    release events. A held key repeats after `repeatDelay`, getting faster the
+    longer it's held. Repeats aren't queued up while the last one is still
+    unhandled, so scrolling runs as fast as the screen redraws and stops as soon
+    as the key is let go.
+
+    Attributes:
+        `pins`              GPIO pins of the keys, wired active low\n
+        `debounce`          Seconds a pin has to settle before another change counts\n
+        `repeatDelay`       Seconds a key is held before it starts repeating\n
+        `repeatInterval`    Seconds between the first repeats\n
+        `repeatMin`         Shortest interval the repeats speed up to\n
+        `acceleration`      Factor applied to the interval after every repeat
+    """
+
+    def __init__(self, pins, debounce=0.03, repeatDelay=0.4, repeatInterval=0.15,
+                 repeatMin=0.03, acceleration=0.85):
+        self.pins = pins
+        self.debounce = debounce
+        self.repeatDelay = repeatDelay
+        self.repeatInterval = repeatInterval
+        self.repeatMin = repeatMin
+        self.acceleration = acceleration
+        self.events = queue.Queue()
+        self.redrawPending = threading.Event()
+        self.cond = threading.Condition()
+        self.pressed = {pin: False for pin in pins}
+        self.changed = {pin: 0.0 for pin in pins}
+        self.held = {}  # pin -> [time of the next repeat, current interval]
+        self.repeatPending = set()  # pins with a repeat still sitting in the queue
+        self.shouldDie = False
+        for pin in pins:
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.on_edge)
+        self.thread = threading.Thread(target=self.repeat_loop, daemon=True)
+        self.thread.start()
+
+    def on_edge(self, pin) -> None:
+        # runs on the GPIO library's callback thread
+        now = time.monotonic()
+        pressed = not GPIO.input(pin)
+        with self.cond:
+            if pressed == self.pressed[pin] or now - self.changed[pin] < self.debounce:
+                return  # contact bounce
+            self.pressed[pin] = pressed
+            self.changed[pin] = now
+            if pressed:
+                self.held[pin] = [now + self.repeatDelay, self.repeatInterval]
+            else:
+                self.held.pop(pin, None)
+            self.cond.notify()
+        self.events.put(KeyEvent(pin, PRESS if pressed else RELEASE, now))
+
+    def repeat_loop(self) -> None:
+        with self.cond:
+            while not self.shouldDie:
+                if not self.held:
+                    self.cond.wait()
+                    continue
+                now = time.monotonic()
+                due = min(at for at, _ in self.held.values())
+                if due > now:
+                    self.cond.wait(due - now)
+                    continue
+                for pin, timing in list(self.held.items()):
+                    if timing[0] > now:
+                        continue
+                    if GPIO.input(pin):
+                        # the release got lost in a bounce
+                        self.held.pop(pin)
+                        self.pressed[pin] = False
+                        self.changed[pin] = now
+                        self.events.put(KeyEvent(pin, RELEASE, now))
+                        continue
+                    timing[0] = now + timing[1]
+                    timing[1] = max(self.repeatMin, timing[1] * self.acceleration)
+                    if pin not in self.repeatPending:
+                        self.repeatPending.add(pin)
+                        self.events.put(KeyEvent(pin, REPEAT, now))
+
+    def redraw(self) -> None:
+        """Wakes up the active element to draw itself again, safe to call from any thread"""
+        if not self.redrawPending.is_set():
+            self.redrawPending.set()
+            self.events.put(KeyEvent(REDRAW, PRESS, time.monotonic()))
+
+    def next_event(self, timeout=None):
+        """Blocks until the next `KeyEvent`, returns None on timeout"""
+        try:
+            event = self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if event.pin == REDRAW:
+            self.redrawPending.clear()
+        elif event.kind == REPEAT:
+            with self.cond:
+                self.repeatPending.discard(event.pin)
+        return event
+
+    def wait(self, timeout=None, repeat=(), release=()):
+        """
+        Blocks until a key is pressed and returns its pin, or `REDRAW`.
+        Held keys listed in `repeat` count as pressed again on every repeat,
+        keys listed in `release` also return `RELEASED + pin` when let go.
+        Returns None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            event = self.next_event(remaining)
+            if event is None:
+                return None
+            if event.kind == PRESS or event.kind == REPEAT and event.pin in repeat:
+                return event.pin
+            if event.kind == RELEASE and event.pin in release:
+                return RELEASED + event.pin
+
+    def clear(self) -> None:
+        """Drops the presses that piled up while an action was running"""
+        while self.next_event(0) is not None:
+            pass
+
+    def is_pressed(self, pin) -> bool:
+        return self.pressed.get(pin, False)
+
+    def close(self) -> None:
+        with self.cond:
+            self.shouldDie = True
+            self.cond.notify()
+        for pin in self.pins:
+            GPIO.remove_event_detect(pin)
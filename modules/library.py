@@ -0,0 +1,196 @@
+import os
+import json
+import sqlite3
+import threading
+
+from modules.scanner import LibraryScanner, list_dir
+
+# the index lives next to main.py so it survives reboots
+INDEX_FILE = os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), "library.db")
+# bump whenever the table layout changes, old indexes get rebuilt from scratch
+SCHEMA_VERSION = 3
+
+
+class LibraryIndex:
+    """
+    On-disk cache of the track listing of every playlist folder.
+
+    Every directory of the library is keyed by its path and remembers its mtime from
+    when it was last listed, so a boot only re-lists the directories that actually
+    changed. The flattened track list of each playlist is kept alongside.
+
+    Attributes:
+        `root`          Parent directory of the playlist folders\n
+        `path`          Location of the SQLite database file\n
+        `workers`       Number of directories scanned at the same time
+
+        `scheduler`     Optional `IOScheduler` throttling the directory reads
+    """
+
+    def __init__(self, root, path=INDEX_FILE, workers=4, scheduler=None):
+        self.root = root
+        self.path = path
+        # the player callbacks come from omxplayer's dbus thread, share one connection
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS folders")
+            self.db.execute("DROP TABLE IF EXISTS dirs")
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS dirs (
+                               path TEXT PRIMARY KEY,
+                               mtime REAL NOT NULL,
+                               files TEXT NOT NULL,
+                               subdirs TEXT NOT NULL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS folders (
+                               name TEXT PRIMARY KEY,
+                               count INTEGER NOT NULL,
+                               tracks TEXT NOT NULL)""")
+        self.db.commit()
+        self.scanner = LibraryScanner(root, self.list_cached, workers, scheduler)
+        self.mtimes = {}
+
+    def list_cached(self, path) -> tuple:
+        """Lister for the scanner, only touches the disk if the mtime moved"""
+        mtime = os.stat(f"{self.root}/{path}").st_mtime
+        if self.mtimes.get(path) == mtime:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT files, subdirs FROM dirs WHERE path = ?", (path,)).fetchone()
+            if row:
+                return mtime, json.loads(row[0]), json.loads(row[1]), False
+        self.scanner.scheduler.acquire()
+        files, subdirs = list_dir(f"{self.root}/{path}")
+        return mtime, files, subdirs, True
+
+    def refresh(self, on_playlist=None, on_changed=None) -> list:
+        """
+        Syncs the index with the music directory and returns a sorted list of
+        `(name, count)` tuples, one per playlist folder.\n
+        `on_playlist(name, count)` is called as each playlist finishes scanning\n
+        `on_changed(name, before, after)` is called with the old and new track lists
+        of every playlist whose tree changed
+        """
+        names = []
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_dir() and not entry.name.startswith('.'):
+                    names.append(entry.name)
+        counts = self._scan(names, on_playlist, on_changed)
+        with self.lock:
+            # whatever is left over was deleted from the disk
+            for (name,) in self.db.execute("SELECT name FROM folders").fetchall():
+                if name not in counts:
+                    self.db.execute("DELETE FROM folders WHERE name = ?", (name,))
+                    self.db.execute(
+                        "DELETE FROM dirs WHERE path = ? OR path LIKE ?", (name, f"{name}/%"))
+            self.db.commit()
+        return sorted(counts.items())
+
+    def refresh_folder(self, name) -> bool:
+        """Re-lists the changed directories of a single playlist, returns True if any did"""
+        changed = []
+        self._scan([name], on_changed=lambda *args: changed.append(True))
+        return bool(changed)
+
+    def rename_folder(self, old, new) -> None:
+        """Moves the entries of playlist `old` to `new` after the folder was renamed on disk"""
+        prefix = f"{old}/"
+        with self.lock:
+            self.db.execute("DELETE FROM folders WHERE name = ?", (new,))
+            self.db.execute("DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?",
+                            (new, len(new) + 1, f"{new}/"))
+            self.db.execute("UPDATE folders SET name = ? WHERE name = ?", (new, old))
+            # a rename keeps the mtimes of the directories inside, so they needn't be listed again
+            self.db.execute("UPDATE dirs SET path = ? || substr(path, ?) WHERE path = ? OR substr(path, 1, ?) = ?",
+                            (new, len(old) + 1, old, len(prefix), prefix))
+            self.db.commit()
+            for path in [p for p in self.mtimes if p == old or p.startswith(prefix)]:
+                self.mtimes[new + path[len(old):]] = self.mtimes.pop(path)
+
+    def count(self, name) -> int:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT count FROM folders WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def folders(self) -> list:
+        """Returns the path of every indexed directory, relative to the music directory"""
+        with self.lock:
+            return [path for (path,) in self.db.execute("SELECT path FROM dirs ORDER BY path")]
+
+    def tracks(self, name) -> list:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT tracks FROM folders WHERE name = ?", (name,)).fetchone()
+        if not row:
+            return []
+        return json.loads(row[0])
+
+    def rebuild(self, on_playlist=None) -> list:
+        """Throws away the whole index and lists every folder again"""
+        with self.lock:
+            self.db.execute("DELETE FROM dirs")
+            self.db.execute("DELETE FROM folders")
+            self.db.commit()
+            self.mtimes = {}
+        return self.refresh(on_playlist)
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def _scan(self, names, on_playlist=None, on_changed=None) -> dict:
+        with self.lock:
+            for path, mtime in self.db.execute("SELECT path, mtime FROM dirs"):
+                self.mtimes[path] = mtime
+        visited = set()
+        listed = []
+        counts = {}
+
+        def on_dir(path, mtime, files, subdirs, changed):
+            visited.add(path)
+            if changed:
+                listed.append(path)
+                self.mtimes[path] = mtime
+                # committed right away, the next listing may wait on the I/O scheduler
+                # and nothing should hold the write lock meanwhile
+                with self.lock:
+                    try:
+                        self.db.execute("INSERT OR REPLACE INTO dirs (path, mtime, files, subdirs) VALUES (?, ?, ?, ?)",
+                                        (path, mtime, json.dumps(files), json.dumps(subdirs)))
+                        self.db.commit()
+                    except sqlite3.Error as e:
+                        # listed again on the next scan
+                        print(f"Can't index {path}: {e}")
+                        self.db.rollback()
+                        self.mtimes.pop(path, None)
+
+        def on_done(name, tracks, changed):
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT tracks FROM folders WHERE name = ?", (name,)).fetchone()
+                if changed or not row:
+                    self.db.execute("INSERT OR REPLACE INTO folders (name, count, tracks) VALUES (?, ?, ?)",
+                                    (name, len(tracks), json.dumps(tracks)))
+                    # drop the subfolders that disappeared from this playlist
+                    gone = [p for p in self.mtimes if (p == name or p.startswith(
+                        f"{name}/")) and p not in visited]
+                    for p in gone:
+                        self.db.execute("DELETE FROM dirs WHERE path = ?", (p,))
+                        self.mtimes.pop(p, None)
+                    self.db.commit()
+            counts[name] = len(tracks)
+            if (changed or not row) and on_changed:
+                on_changed(name, json.loads(row[0]) if row else [], tracks)
+            if on_playlist:
+                on_playlist(name, len(tracks))
+
+        self.scanner.scan(names, on_dir, on_done)
+        print(
+            f"Library index: {len(names)} playlists, {len(visited)} folders checked, {len(listed)} rescanned")
+        if listed:
+            print(f"Scan I/O: {self.scanner.scheduler.report()}")
+        return counts
@@ -0,0 +1,187 @@
+import os
+import time
+import socket
+import selectors
+import threading
+from evdev import InputDevice
+
+INPUT_DIR = "/dev/input"
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL = 1  # multicast group of the kernel's own uevents
+
+EV_KEY = 1
+KEY_PRESS = 1  # event value, 0 is a release and 2 an autorepeat
+KEY_PAUSE = 119
+KEY_NEXTSONG = 163
+KEY_PLAYPAUSE = 164
+KEY_PREVIOUSSONG = 165
+KEY_PLAYCD = 200
+KEY_PAUSECD = 201
+KEY_PLAY = 207
+# a device with any of these is a speaker or a remote
+MEDIA_KEYS = {KEY_PAUSE, KEY_NEXTSONG, KEY_PLAYPAUSE, KEY_PREVIOUSSONG, KEY_PLAYCD, KEY_PAUSECD, KEY_PLAY}
+
+
+class MediaKeys:
+    """
+    Media key presses from every speaker and remote that's connected, all read on one thread.
+
+    Input devices are picked by their capabilities, anything with a play, pause
+    or track key counts, so it doesn't matter which event node a speaker gets or
+    how many there are. The kernel announces input devices coming and going on a
+    netlink socket, which is watched by the same selector as the devices. If the
+    socket can't be opened, the input directory is rescanned every `rescanInterval`
+    seconds instead.
+
+    Attributes:
+        `onKey`             Callback taking the key code of every media key press\n
+        `onChange`          Optional callback taking the `InputDevice` that came or went and whether it's there\n
+        `rescanInterval`    Seconds between rescans without netlink
+    """
+
+    def __init__(self, onKey, onChange=None, rescanInterval=5):
+        self.onKey = onKey
+        self.onChange = onChange
+        self.rescanInterval = rescanInterval
+        self.selector = selectors.DefaultSelector()
+        self.devices = {}  # path -> InputDevice
+        self.pending = {}  # path -> time to give up opening it, udev may not be done with it yet
+        self.uevents = None
+        self.shouldDie = False
+        self.thread = None
+
+    def start(self) -> None:
+        if self.thread and self.thread.is_alive():
+            return
+        try:
+            self.uevents = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_KOBJECT_UEVENT)
+            self.uevents.bind((0, UEVENT_KERNEL))
+            self.selector.register(self.uevents, selectors.EVENT_READ, None)
+        except (OSError, AttributeError) as e:
+            print(f"Can't watch for input devices, rescanning instead: {e}")
+            self.uevents = None
+        self.shouldDie = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.shouldDie = True
+
+    def names(self) -> list:
+        return [device.name for device in list(self.devices.values())]
+
+    def run(self) -> None:
+        self.scan()
+        lastScan = time.monotonic()
+        while not self.shouldDie:
+            timeout = 1  # to notice `shouldDie`
+            if self.pending:
+                timeout = 0.2
+            elif not self.uevents:
+                timeout = max(lastScan + self.rescanInterval - time.monotonic(), 0)
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    self.read_uevents()
+                else:
+                    self.read_device(key.data)
+            for path, deadline in list(self.pending.items()):
+                if self.add(path) or time.monotonic() > deadline:
+                    self.pending.pop(path, None)
+            if not self.uevents and time.monotonic() - lastScan >= self.rescanInterval:
+                self.scan()
+                lastScan = time.monotonic()
+        for path in list(self.devices):
+            self.remove(path)
+        if self.uevents:
+            self.uevents.close()
+        print("Media keys stopped")
+
+    def scan(self) -> None:
+        try:
+            nodes = [f"{INPUT_DIR}/{name}" for name in os.listdir(INPUT_DIR) if name.startswith("event")]
+        except OSError:
+            nodes = []
+        for path in nodes:
+            if path not in self.devices:
+                self.add(path)
+        for path in list(self.devices):
+            if path not in nodes:
+                self.remove(path)
+
+    def read_uevents(self) -> None:
+        try:
+            message = self.uevents.recv(8192)
+        except OSError:
+            return
+        # "action@devpath" followed by KEY=value fields, all NUL separated
+        fields = dict(field.split("=", 1) for field in message.decode(errors="replace").split("\0")
+                      if "=" in field)
+        name = fields.get("DEVNAME", "")
+        if fields.get("SUBSYSTEM") != "input" or not name.startswith("input/event"):
+            return
+        path = f"/dev/{name}"
+        if fields.get("ACTION") == "add":
+            if not self.add(path):
+                self.pending[path] = time.monotonic() + 5
+        elif fields.get("ACTION") == "remove":
+            self.pending.pop(path, None)
+            self.remove(path)
+
+    def add(self, path) -> bool:
+        """Starts reading `path` if it has media keys, False if it couldn't be opened (yet)"""
+        if path in self.devices:
+            return True
+        try:
+            device = InputDevice(path)
+        except OSError:
+            return False
+        try:
+            keys = set(device.capabilities().get(EV_KEY, []))
+        except OSError:
+            device.close()
+            return False
+        if not keys & MEDIA_KEYS:
+            device.close()
+            return True  # not one of ours, nothing to retry
+        self.devices[path] = device
+        self.selector.register(device, selectors.EVENT_READ, path)
+        print(f"Media keys found: {device.name} ({path})")
+        self.changed(device, True)
+        return True
+
+    def remove(self, path) -> None:
+        device = self.devices.pop(path, None)
+        if device is None:
+            return
+        try:
+            self.selector.unregister(device)
+        except (KeyError, ValueError):
+            pass
+        try:
+            device.close()
+        except OSError:
+            pass
+        print(f"Media keys gone: {device.name} ({path})")
+        self.changed(device, False)
+
+    def changed(self, device, present) -> None:
+        if self.onChange:
+            self.onChange(device, present)
+
+    def read_device(self, path) -> None:
+        device = self.devices.get(path)
+        if device is None:
+            return
+        try:
+            events = list(device.read())
+        except BlockingIOError:
+            return
+        except OSError:
+            self.remove(path)  # unplugged, the uevent may come after
+            return
+        for event in events:
+            if event.type == EV_KEY and event.value == KEY_PRESS and event.code in MEDIA_KEYS:
+                try:
+                    self.onKey(event.code)
+                except Exception as e:
+                    print(f"Media key {event.code} failed: {e}")
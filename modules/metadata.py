@@ -0,0 +1,306 @@
+import os
+import struct
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.library import INDEX_FILE
+from modules.iosched import IOScheduler
+
+# never read more than this much of a tag, cover art is skipped with seeks
+MAX_FRAME_READ = 1024
+SYNC_SEARCH = 16 * 1024
+
+# ID3v2.3/2.4 frame ids, then their ID3v2.2 equivalents
+TEXT_FRAMES = {b"TIT2": "title", b"TPE1": "artist", b"TALB": "album", b"TLEN": "length",
+               b"TT2": "title", b"TP1": "artist", b"TAL": "album", b"TLE": "length"}
+
+# kbps by [mpeg 1 or 2][layer 1-3][bitrate index]
+BITRATES = {
+    1: {1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)},
+    2: {1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)}
+}
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+class Metadata:
+    """
+    Track information read from the file headers.
+
+    Attributes:
+        `title`         Song title, falls back to the file name\n
+        `artist`        Performing artist (or None)\n
+        `album`         Album name (or None)\n
+        `duration`      Length in seconds (or None if it couldn't be worked out)
+    """
+
+    def __init__(self, title, artist=None, album=None, duration=None):
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.duration = duration
+
+    def __repr__(self):
+        return f"{self.title} - {self.artist}" if self.artist else self.title
+
+    def length(self) -> str:
+        if self.duration is None:
+            return "?:??"
+        minutes, seconds = divmod(round(self.duration), 60)
+        return f"{minutes}:{seconds:02d}"
+
+
+def synchsafe(data) -> int:
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def decode_text(data) -> str:
+    encoding = data[0] if data else 0
+    raw = data[1:]
+    if encoding == 1:
+        text = raw.decode("utf-16", "replace")
+    elif encoding == 2:
+        text = raw.decode("utf-16-be", "replace")
+    elif encoding == 3:
+        text = raw.decode("utf-8", "replace")
+    else:
+        text = raw.decode("latin-1")
+    # v2.4 separates multiple values with nulls, keep the first
+    return text.split("\0")[0].strip()
+
+
+def read_id3v2(f) -> tuple:
+    """Returns the text frames we care about and the offset where the audio starts"""
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return {}, 0
+    version = header[3]
+    flags = header[5]
+    end = 10 + synchsafe(header[6:10])
+    if flags & 0x10:
+        end += 10  # footer
+    found = {}
+    if version == 2:
+        headerSize, idSize = 6, 3
+    else:
+        headerSize, idSize = 10, 4
+    pos = 10
+    if version >= 3 and flags & 0x40:
+        # skip the extended header
+        f.seek(pos)
+        ext = f.read(4)
+        pos += synchsafe(ext) if version == 4 else struct.unpack(">I", ext)[0] + 4
+    while pos + headerSize <= end and len(found) < 4:
+        f.seek(pos)
+        frame = f.read(headerSize)
+        frameId = frame[:idSize]
+        if len(frame) < headerSize or not frameId.strip(b"\0"):
+            break  # reached the padding
+        if version == 2:
+            size = int.from_bytes(frame[3:6], "big")
+        elif version == 4:
+            size = synchsafe(frame[4:8])
+        else:
+            size = struct.unpack(">I", frame[4:8])[0]
+        if frameId in TEXT_FRAMES:
+            found[TEXT_FRAMES[frameId]] = decode_text(f.read(min(size, MAX_FRAME_READ)))
+        pos += headerSize + size
+    return found, end
+
+
+def read_id3v1(f, fileSize) -> dict:
+    if fileSize < 128:
+        return {}
+    f.seek(fileSize - 128)
+    tag = f.read(128)
+    if tag[:3] != b"TAG":
+        return {}
+
+    def field(data):
+        return data.split(b"\0")[0].decode("latin-1").strip() or None
+    return {"title": field(tag[3:33]), "artist": field(tag[33:63]), "album": field(tag[63:93])}
+
+
+def read_mpeg_duration(f, start, fileSize):
+    """Works out the length from the first MPEG frame and its Xing/Info/VBRI header"""
+    f.seek(start)
+    data = f.read(SYNC_SEARCH)
+    for i in range(len(data) - 4):
+        if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+            continue
+        b1, b2, b3 = data[i + 1], data[i + 2], data[i + 3]
+        versionBits = (b1 >> 3) & 0x03
+        layer = 4 - ((b1 >> 1) & 0x03)
+        bitrateIndex = b2 >> 4
+        rateIndex = (b2 >> 2) & 0x03
+        if versionBits == 1 or layer == 4 or bitrateIndex in (0, 15) or rateIndex == 3:
+            continue  # not a real frame header, keep looking
+        mpeg = 1 if versionBits == 3 else 2
+        sampleRate = SAMPLE_RATES[versionBits][rateIndex]
+        mono = (b3 >> 6) == 3
+        if layer == 1:
+            samples = 384
+        elif layer == 3 and mpeg == 2:
+            samples = 576
+        else:
+            samples = 1152
+        # Xing/Info header sits right after the side information
+        if mpeg == 1:
+            sideInfo = 17 if mono else 32
+        else:
+            sideInfo = 9 if mono else 17
+        xing = i + 4 + sideInfo
+        if data[xing:xing + 4] in (b"Xing", b"Info"):
+            xingFlags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+            if xingFlags & 0x01:
+                frames = struct.unpack(">I", data[xing + 8:xing + 12])[0]
+                return frames * samples / sampleRate
+        vbri = i + 4 + 32
+        if data[vbri:vbri + 4] == b"VBRI":
+            frames = struct.unpack(">I", data[vbri + 14:vbri + 18])[0]
+            return frames * samples / sampleRate
+        # plain CBR, the size of the audio gives the length
+        bitrate = BITRATES[mpeg][layer][bitrateIndex] * 1000
+        return (fileSize - start - i) * 8 / bitrate
+    return None
+
+
+def read_metadata(path, fileSize=None) -> Metadata:
+    """Parses the ID3 tags and the first MPEG frame without reading the whole file"""
+    if fileSize is None:
+        fileSize = os.path.getsize(path)
+    fallback = os.path.splitext(os.path.basename(path))[0]
+    if not path.lower().endswith(".mp3"):
+        return Metadata(fallback)
+    with open(path, "rb") as f:
+        tags, audioStart = read_id3v2(f)
+        if not tags:
+            tags = read_id3v1(f, fileSize)
+        duration = read_mpeg_duration(f, audioStart, fileSize)
+    if duration is None and tags.get("length", "").isdigit():
+        duration = int(tags["length"]) / 1000
+    return Metadata(tags.get("title") or fallback, tags.get("artist"), tags.get("album"), duration)
+
+
+class MetadataCache:
+    """
+    Reads track metadata on a small pool of background threads and remembers it,
+    in memory and in the library database keyed by `(path, size, mtime)`, so a file
+    is only ever parsed once.
+
+    Attributes:
+        `onUpdate`      Optional callback taking the path of a track whose metadata just arrived\n
+        `workers`       Number of files read at the same time\n
+        `memory`        Number of entries kept in memory
+
+        `scheduler`     Optional `IOScheduler` the tag reads go through
+
+        `index`         Optional `LibraryIndex` whose database connection is shared, a second
+        connection to the same file would run into its write lock during scans
+    """
+
+    def __init__(self, onUpdate=None, path=INDEX_FILE, workers=2, memory=2000, scheduler=None, index=None):
+        self.onUpdate = onUpdate
+        self.memory = memory
+        self.entries = OrderedDict()  # path -> Metadata, least recently used first
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.ownDb = index is None
+        if index:
+            self.db = index.db
+            self.dbLock = index.lock
+        else:
+            self.db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+            self.dbLock = threading.Lock()
+        with self.dbLock:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                                   path TEXT PRIMARY KEY,
+                                   size INTEGER NOT NULL,
+                                   mtime REAL NOT NULL,
+                                   title TEXT NOT NULL,
+                                   artist TEXT,
+                                   album TEXT,
+                                   duration REAL)""")
+            self.db.commit()
+        self.scheduler = scheduler or IOScheduler(rate=0, idle=False)
+        self.pool = ThreadPoolExecutor(max_workers=workers, initializer=self.scheduler.worker_init)
+
+    def get(self, path):
+        """Returns the metadata if it's known, otherwise queues it up and returns None"""
+        with self.lock:
+            meta = self.entries.get(path)
+            if meta:
+                self.entries.move_to_end(path)
+                return meta
+        self.request(path)
+        return None
+
+    def title(self, path, fetch=True) -> str:
+        """Returns the track title, or the file name until the metadata is read"""
+        if fetch:
+            meta = self.get(path)
+        else:
+            with self.lock:
+                meta = self.entries.get(path)
+        return meta.title if meta else os.path.splitext(os.path.basename(path))[0]
+
+    def known_titles(self, folder) -> dict:
+        """Titles of every track under `folder` that was ever read, in one query"""
+        # paths in the folder sort between "folder/" and "folder0"
+        with self.dbLock:
+            rows = self.db.execute("SELECT path, title FROM metadata WHERE path >= ? AND path < ?",
+                                   (f"{folder}/", f"{folder}0")).fetchall()
+        return dict(rows)
+
+    def request(self, path) -> None:
+        with self.lock:
+            if path in self.entries or path in self.pending:
+                return
+            self.pending.add(path)
+        self.pool.submit(self.load, path)
+
+    def prefetch(self, paths) -> None:
+        for p in paths:
+            self.request(p)
+
+    def load(self, path) -> None:
+        try:
+            stat = os.stat(path)
+            with self.dbLock:
+                row = self.db.execute("SELECT title, artist, album, duration FROM metadata WHERE path = ? AND size = ? AND mtime = ?",
+                                      (path, stat.st_size, stat.st_mtime)).fetchone()
+            if row:
+                meta = Metadata(*row)
+            else:
+                self.scheduler.acquire()
+                meta = read_metadata(path, stat.st_size)
+                with self.dbLock:
+                    self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (path, stat.st_size, stat.st_mtime, meta.title, meta.artist, meta.album, meta.duration))
+                    self.db.commit()
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            print(f"Can't read metadata of {path}: {e}")
+            meta = Metadata(os.path.splitext(os.path.basename(path))[0])
+        except sqlite3.Error as e:
+            print(f"Can't cache metadata of {path}: {e}")
+            with self.dbLock:
+                self.db.rollback()
+            meta = Metadata(os.path.splitext(os.path.basename(path))[0])
+        with self.lock:
+            self.pending.discard(path)
+            self.entries[path] = meta
+            while len(self.entries) > self.memory:
+                self.entries.popitem(last=False)
+        if self.onUpdate:
+            self.onUpdate(path)
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False)
+        if self.ownDb:
+            with self.dbLock:
+                self.db.close()
@@ -1,198 +1,500 @@
-from subprocess import call, Popen, PIPE, DEVNULL, check_output
-from evdev import eventio, uinput, InputEvent, InputDevice, categorize, ecodes
 import time
 import os
+import sqlite3
 import threading
-import random
+import bisect
+import itertools
 from omxplayer import OMXPlayer
 
-from modules.bluetooth import BTHack
+from modules.bluetooth import BTHack, BlueZ
+from modules.reconnect import Reconnector
+from modules.mediakeys import (MediaKeys, KEY_NEXTSONG, KEY_PREVIOUSSONG, KEY_PLAYPAUSE, KEY_PLAYCD,
+                               KEY_PAUSECD, KEY_PLAY, KEY_PAUSE)
+from modules.library import LibraryIndex, INDEX_FILE
+from modules.watcher import LibraryWatcher
+from modules.metadata import MetadataCache
+from modules.playqueue import PlayQueue
+from modules.collation import CollationIndex
+from modules.shuffle import TrackTable, ShuffleSource
+from modules.state import PlaybackSnapshot, STATE_FILE
+from modules.iosched import IOScheduler
+from modules.playerstate import PlayerState
 
 MUSIC_DIR = "/home/pi/music/playlists"
+# seconds before the end of a track when the next one gets loaded
+PREFETCH_LEAD = 8
+# millibels the prefetched player starts at, it plays a moment before it's paused
+PREFETCH_VOLUME = -6000
+# seconds between real position reads for the I/O scheduler, extrapolated in between
+PROBE_SYNC = 3
 
 
 class InputManager:
-    def __init__(self, music):
+    def __init__(self, music, bluez=None, registry=None):
         self.music = music
-        self.shouldReconnect = False
-        self.mac = None
+        self.bluez = bluez or BlueZ.shared()
+        # gets the speaker back when it drops, see `Reconnector.follow`
+        self.reconnect = Reconnector(music, self.bluez, registry)
         self.jbl = False
-        self.thread = None
         self.spamTime = 0
         self.spamTimer = 2
         self.skipTime = 0
         self.skipTimer = 4  # change the actuation time slow/fast
         self.switchTime = 0
         self.switchTimer = 4  # change the actuation time slow/fast
-        self.shouldDie = False
-
-    def programmer(self):
-        dev = InputDevice('/dev/input/event0')
-
-        print("Listening for inputs...\n")
-        for event in dev.read_loop():
-            if self.shouldDie:
-                print("listener will die now...")
-                break
-            # there are duplicate inputs for some reason
-            if time.time() - self.spamTime <= self.spamTimer:
-                #print("ignoring spam")
-                continue
-            self.spamTime = time.time()
-
-            if event.code != 0:
-                yield event.code
-
-    def listener(self):
-        if not os.path.exists('/dev/input/event0'):
-            print("\nNo event0 found!")
+        # every speaker and remote with media keys, picked up as they connect
+        self.keys = MediaKeys(self.on_key, self.on_devices)
+        self.keys.start()
+
+    def on_devices(self, device, present) -> None:
+        # BlueZ puts the speaker's address in the uniq of its AVRCP keys, a remote
+        # going away says nothing about the speaker
+        mac = self.reconnect.mac
+        if not present and mac and (getattr(device, "uniq", "") or "").upper() == mac:
+            # gone with the speaker, quicker than waiting for BlueZ to notice
+            self.reconnect.dropped()
+
+    def on_key(self, code) -> None:
+        # there are duplicate inputs for some reason
+        if time.time() - self.spamTime <= self.spamTimer:
+            #print("ignoring spam")
             return
-        try:
-            dev = InputDevice('/dev/input/event0')
-
-            print("Listening for inputs...\n")
-            for event in dev.read_loop():
-                if self.shouldDie:
-                    break
-                # there are duplicate inputs for some reason
-                if time.time() - self.spamTime <= self.spamTimer:
-                    #print("ignoring spam")
-                    continue
-                self.spamTime = time.time()
-
-                if self.jbl:
-                    if event.code == 163:
-                        # if command repeated in rapid succession: skip
-                        if time.time() - self.switchTime <= self.switchTimer:
-                            # user wants to switch playlists
-                            #print("switch called")
-                            self.skipTime = 0
-                            self.switchTime = 0
-                            self.music.switch_playlists()
-                            continue
-                        elif time.time() - self.skipTime <= self.skipTimer:
-                            #print("skip called")
-                            self.skipTime = 0
-                            self.switchTime = time.time()
-                            self.music.skip()
-                            continue
-
-                        self.skipTime = time.time()
-                        self.music.toggle_pause()
-                    elif event.code == 200:
-                        self.music.play()
-                    elif event.code == 201:
-                        # this code occurs when there is actually output on the speaker
-                        # should use it to check if the player is being stupid
-                        self.music.toggle_pause()
-                    else:
-                        print(f"strange  code: {event.code}")
-                else:
-                    if event.code == 163:
-                        self.music.skip()
-                    elif event.code == 200:
-                        self.music.play()
-                    elif event.code == 201:
-                        self.music.toggle_pause()
-                    else:
-                        print(f"strange code: {event.code}")
-        except Exception as e:
-            print(e)
-        finally:
-            if self.music.player:
-                try:
-                    self.music.player.pause()
-                except Exception as e:
-                    print(e)
-                else:
-                    print("Paused music (disconnected)")
-            if self.shouldReconnect:
-                thread = threading.Thread(
-                    target=self.attempt_reconnect, args=(self.mac,))
-                thread.start()
-            self.music.curDevice = None
-            if self.thread:
-                self.thread = None
-            #print("something happened!")
-
-    def create_input_listener(self, force=False):
-        if not os.path.exists('/dev/input/event0'):
-            return False
-        elif self.thread != None and self.thread.is_alive() and not force:
-            return True
+        self.spamTime = time.time()
+
+        if self.jbl:
+            if code == KEY_NEXTSONG:
+                # if command repeated in rapid succession: skip
+                if time.time() - self.switchTime <= self.switchTimer:
+                    # user wants to switch playlists
+                    #print("switch called")
+                    self.skipTime = 0
+                    self.switchTime = 0
+                    self.music.switch_playlists()
+                    return
+                elif time.time() - self.skipTime <= self.skipTimer:
+                    #print("skip called")
+                    self.skipTime = 0
+                    self.switchTime = time.time()
+                    self.music.skip()
+                    return
+
+                self.skipTime = time.time()
+                self.music.toggle_pause()
+            elif code in (KEY_PLAYCD, KEY_PLAY):
+                self.music.play()
+            elif code in (KEY_PAUSECD, KEY_PAUSE, KEY_PLAYPAUSE):
+                # this code occurs when there is actually output on the speaker
+                # should use it to check if the player is being stupid
+                self.music.toggle_pause()
+            elif code == KEY_PREVIOUSSONG:
+                self.music.restart_track()
+            else:
+                print(f"strange  code: {code}")
         else:
-            self.thread = threading.Thread(target=self.listener)
-            self.thread.start()
-            return True
-
-    def attempt_reconnect(self, mac):
-        print("Trying to reconnect speaker...")
-        time.sleep(10)
-        restored = False
-        for i in range(4):
-            try:
-                check_output(f'bluetoothctl connect {mac}'.split(' '))
-            except Exception as e:
-                info = check_output(f'bluetoothctl info {mac}'.split(
-                    ' ')).decode().replace('\t', '').split('\n')
-                if not "Connected: yes" in info:
-                    if i != 3:
-                        print(f"Failed attempt {i + 1} of 4...")
-                    else:
-                        print("Failed to reconnect speaker.")
-                else:
-                    restored = True
-                    break
-                time.sleep(10)
+            if code == KEY_NEXTSONG:
+                self.music.skip()
+            elif code in (KEY_PLAYCD, KEY_PLAY):
+                self.music.play()
+            elif code in (KEY_PAUSECD, KEY_PAUSE, KEY_PLAYPAUSE):
+                self.music.toggle_pause()
+            elif code == KEY_PREVIOUSSONG:
+                self.music.restart_track()
             else:
-                restored = True
-                break
-        if restored:
-            print("Restored bluetooth connection!")
-            if self.music.player and self.music.player.playback_status() == "Paused":
-                try:
-                    self.music.toggle_pause(self)
-                except Exception as e:
-                    print(e)
-                else:
-                    print("Resuming playback.")
+                print(f"strange code: {code}")
+
+    def close(self) -> None:
+        self.keys.stop()
 
 
 class Playlist:
-    def __init__(self, name):
+    """
+    Handle for a playlist folder. Only the name and the indexed track count are
+    kept until the track list is first accessed, then it gets loaded and shuffled.
+
+    The queue draws its tracks from a seeded permutation of `table` as it goes,
+    so shuffling never has to build the whole shuffled list.
+    """
+
+    def __init__(self, name, index, totalTracks=0):
         self.name = name
-        self.tracks = []
-        self.totalTracks = 0
-        self.load_tracks()
+        self.index = index
+        self._tracks = None
+        self.table = None
+        self.totalTracks = totalTracks
+        self.collation = None  # alphabetical index of the queue, made when first asked for
+
+    @property
+    def tracks(self):
+        self.ensure_loaded()
+        return self._tracks
+
+    @tracks.setter
+    def tracks(self, value):
+        self._tracks = value
+        self.collation = None  # it followed the old queue
+
+    def is_loaded(self) -> bool:
+        return self._tracks is not None
+
+    def ensure_loaded(self):
+        if self._tracks is None:
+            self.load_tracks()
 
     def load_tracks(self):
-        self.tracks = os.listdir(f"{MUSIC_DIR}/{self.name}")
-        self.totalTracks = len(self.tracks)
-        self.shuffle()
+        # picks up new files if the folder changed since it was indexed
+        self.index.refresh_folder(self.name)
+        self.table = TrackTable(self.index.tracks(self.name))
+        self.totalTracks = self.table.live
+        self.reshuffle()
         print(f"Playlist '{self.name}' has {self.totalTracks} tracks!")
 
-    def shuffle(self):
-        # for i in range(len(self.tracks)-1, 0, -1):
-        #    j = random.randint(0, i+1)
-        #    self.tracks[i], self.tracks[j] = self.tracks[j], self.tracks[i]
-        random.shuffle(self.tracks)
+    def reshuffle(self, seed=None, cursor=0):
+        """
+        Starts a new shuffled pass over the playlist in O(1), passing the `seed` and
+        `cursor` of an earlier pass picks it up again in the exact same order
+        """
+        if self.table is None:
+            self.load_tracks()
+        if self.table.live < len(self.table) // 2:
+            # mostly removed tracks, drop the empty slots
+            self.table = TrackTable(t for t in self.table.tracks if t is not None)
+        self.tracks = PlayQueue(source=ShuffleSource(self.table, seed, cursor))
+
+    def restore(self, state) -> bool:
+        """
+        Rebuilds a queue saved with `PlayQueue.state`. Returns False if the folder
+        changed since, then the queued tracks are kept and the rest is shuffled again
+        """
+        # the scan that found this playlist just brought the index up to date
+        self.table = TrackTable(self.index.tracks(self.name))
+        self.totalTracks = self.table.live
+        known = set(self.table.tracks)
+        head = [t for t in state["head"] if t in known]
+        tail = [t for t in state["tail"] if t in known]
+        source = state["source"]
+        exact = len(head) == len(state["head"]) and len(tail) == len(state["tail"])
+        if not source:
+            self.tracks = PlayQueue(head)
+        elif exact and source["size"] == len(self.table) and source["checksum"] == self.table.checksum():
+            self.tracks = PlayQueue(head, ShuffleSource(
+                self.table, source["seed"], source["cursor"]))
+        else:
+            exact = False
+            queued = set(head) | set(tail)
+            fresh = ShuffleSource(self.table)
+            self.tracks = PlayQueue(head + [t for t in iter(fresh.next, None) if t not in queued])
+        self._tracks.extend(tail)
+        return exact
+
+    def sorted_tracks(self, label) -> CollationIndex:
+        """
+        The queue in alphabetical order by `label`, built on first use and
+        kept up to date as tracks join and leave the queue from then on
+        """
+        queue = self.tracks
+        with queue.lock:
+            if self.collation is None:
+                self.collation = CollationIndex(queue.members(), label)
+                queue.onChange = self.collation.on_change
+            return self.collation
 
 
 class MusicPlayer:
-    def __init__(self):
+    """
+    Plays the shuffled playlist folders one omxplayer at a time.
+
+    Attributes:
+        `scanRate`      Directory and tag reads per second allowed while scanning
+
+        `root`          Parent directory of the playlist folders
+
+        `playerFactory` Called like `OMXPlayer` to start a track, the benchmark swaps in a fake
+
+        `indexPath`     Location of the library database
+
+        `statePath`     Location of the playback snapshot
+
+        `onScan`        Optional callback taking the number of playlists found and whether the scan is done
+
+        `onPlay`        Optional callback taking the path of every track that starts playing
+    """
+
+    def __init__(self, scanRate=50, root=MUSIC_DIR, playerFactory=OMXPlayer,
+                 indexPath=INDEX_FILE, statePath=STATE_FILE):
+        self.root = root
+        self.playerFactory = playerFactory
         self.player = None
+        # what the menus show, kept without asking omxplayer over D-Bus every redraw
+        self.state = PlayerState()
         self.now = None
         self.switching = False
         self.playlists = []
         self.playlistIndex = 0
-        self.fetch_playlists()
         self.closed = False
         self.restart = False
+        # scans and tag reads back off while the current track is being streamed
+        self.io = IOScheduler(rate=scanRate)
+        self.io.probe = self.playback_position
+        self.library = LibraryIndex(root, indexPath, scheduler=self.io)
+        # same connection as the index, sqlite only lets one of them write at a time
+        self.metadata = MetadataCache(path=indexPath, scheduler=self.io, index=self.library)
+        self.titles = {}  # path -> title the sorted queues are ordered by
+        # feeds new/removed files into the playlists without rescanning
+        self.watcher = LibraryWatcher(
+            root, self.library, self.on_library_change)
+        self.scanThread = None
+        self.scanned = threading.Event()  # set once the first scan went through
+        self.onScan = None
+        self.onPlay = None
+        # resume where the last run left off, even after a crash or power cut
+        self.snapshot = PlaybackSnapshot(self.collect_state, statePath)
+        self.resume = self.snapshot.load()
+        self.resumePosition = 0
+        self.resumePlaying = False
+        self.resumeAllowed = False
+        # the next track waits paused in its own omxplayer so it starts without a gap
+        self.nextPlayer = None
+        self.nextPath = None
+        self.prefetchLock = threading.Lock()
+        self.dbusIds = itertools.count(1)  # every omxplayer needs its own bus name
+        self.stopTime = None
+        self.lastTransition = None
+        self.fetch_playlists()
+        self.snapshot.start()
+        self.state.start()
+
+    def fetch_playlists(self, rebuild=False):
+        """
+        Scans the library in the background, each playlist becomes
+        available as soon as its folder tree has been scanned
+        """
+        if self.scanThread and self.scanThread.is_alive():
+            return
+        self.scanThread = threading.Thread(
+            target=self.scan_library, args=(rebuild,), daemon=True)
+        self.scanThread.start()
+
+    def scan_library(self, rebuild=False):
+        def found(name, count):
+            playlist = self.find_playlist(name)
+            if not playlist:
+                self.insert_playlist(Playlist(name, self.library, count))
+            elif not playlist.is_loaded():
+                playlist.totalTracks = count
+            if self.resume and self.resume.get("playlist") == name:
+                self.restore_state()
+            if self.onScan:
+                self.onScan(len(self.playlists), False)
+        try:
+            if rebuild:
+                folders = self.library.rebuild(on_playlist=found)
+            else:
+                folders = self.library.refresh(on_playlist=found)
+        except OSError as e:
+            print(f"Can't scan {self.root}: {e}")
+            self.scan_done()
+            return
+        except sqlite3.Error as e:
+            # the playlists found so far stay, the watcher keeps them current
+            print(f"Library index failed mid-scan: {e}")
+            self.scan_done()
+            self.watcher.start()
+            return
+        names = {name for name, _ in folders}
+        for p in list(self.playlists):
+            if p.name not in names:
+                self.remove_playlist(p.name)
+        if self.resume:
+            print(f"Saved playlist '{self.resume.get('playlist')}' is gone, not resuming")
+            self.resume = None
+        self.scan_done()
+        self.watcher.start()
+
+    def scan_done(self) -> None:
+        self.scanned.set()
+        if self.onScan:
+            self.onScan(len(self.playlists), True)
+
+    def playback_position(self):
+        """Position of the playing track for the I/O scheduler, None while nothing plays"""
+        if self.switching or not self.state.is_playing():
+            return None
+        if time.monotonic() - self.state.syncedAt < PROBE_SYNC:
+            return self.state.position()
+        # a stutter shows as the real position falling behind the extrapolated one
+        return self.state.sync()
+
+    def collect_state(self):
+        """Snapshot of the playback state for `PlaybackSnapshot`"""
+        if self.resume or not self.playlists:
+            return None  # don't overwrite a snapshot that wasn't restored yet
+        playlist = self.playlists[self.playlistIndex]
+        if not playlist.is_loaded():
+            return None
+        queue = playlist.tracks
+        position = self.resumePosition
+        playing = False
+        if self.player and not self.switching:
+            position = self.state.position()
+            playing = self.state.is_playing()
+        return {"playlist": playlist.name,
+                "index": self.playlistIndex,
+                "track": queue[0] if queue else None,
+                "position": round(position, 1),
+                "playing": playing,
+                "queue": queue.state(),
+                "time": time.time()}
+
+    def restore_state(self):
+        state, self.resume = self.resume, None
+        playlist = self.find_playlist(state["playlist"])
+        if not playlist:
+            return
+        try:
+            exact = playlist.restore(state["queue"])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Can't restore the saved queue: {e}")
+            return
+        self.playlistIndex = self.playlists.index(playlist)
+        queue = playlist.tracks
+        if queue and queue[0] == state.get("track"):
+            self.resumePosition = state.get("position") or 0
+            self.resumePlaying = bool(state.get("playing"))
+        print(f"Restored {'' if exact else 'part of '}the queue of '{playlist.name}'"
+              f" at {self.resumePosition:.0f}s into '{state.get('track')}'")
+        self.resume_playback(self.resumeAllowed)
+
+    def resume_playback(self, allowed=True):
+        """
+        Starts the restored queue if it was playing when the snapshot was taken.
+        Called once the speaker is ready, playback starts as soon as both happened
+        """
+        self.resumeAllowed = allowed
+        if allowed and self.resumePlaying and not self.player and not self.resume:
+            self.resumePlaying = False
+            # omxplayer takes a moment to come up, don't hold up the caller
+            threading.Thread(target=self.create_player, daemon=True).start()
+
+    def rebuild_library(self):
+        print("Rebuilding library index...")
+        self.fetch_playlists(rebuild=True)
+
+    def track_path(self, playlist, track) -> str:
+        return f"{self.root}/{playlist.name}/{track}"
+
+    def title_of(self, playlist, track) -> str:
+        path = self.track_path(playlist, track)
+        return self.titles.get(path) or self.metadata.title(path, fetch=False)
+
+    def sorted_queue(self, playlist) -> CollationIndex:
+        """The queue of a playlist in alphabetical order by title, see `Playlist.sorted_tracks`"""
+        if playlist.collation is None:
+            # whatever tags were ever read, without touching the files
+            self.titles.update(self.metadata.known_titles(f"{self.root}/{playlist.name}"))
+        return playlist.sorted_tracks(lambda track: self.title_of(playlist, track))
+
+    def on_metadata(self, path) -> None:
+        """Moves a track whose tags just arrived to its place in the sorted queues"""
+        title = self.metadata.title(path, fetch=False)
+        if self.titles.get(path) == title:
+            return
+        self.titles[path] = title
+        for playlist in self.playlists:
+            prefix = f"{self.root}/{playlist.name}/"
+            if playlist.collation is not None and path.startswith(prefix):
+                playlist.collation.relabel(path[len(prefix):])
+
+    def find_playlist(self, name):
+        return next((p for p in self.playlists if p.name == name), None)
+
+    def insert_playlist(self, playlist):
+        # keep the list sorted by name without moving the active playlist
+        names = [p.name for p in self.playlists]
+        i = bisect.bisect(names, playlist.name)
+        self.playlists.insert(i, playlist)
+        if len(self.playlists) > 1 and i <= self.playlistIndex:
+            self.playlistIndex += 1
 
-    def fetch_playlists(self):
-        folders = os.listdir(MUSIC_DIR)
-        for f in folders:
-            self.playlists.append(Playlist(f))
+    def remove_playlist(self, name):
+        names = [p.name for p in self.playlists]
+        i = names.index(name)
+        if i == self.playlistIndex:
+            if self.player:
+                self.switching = True  # don't pop from the next playlist's queue
+            self.playlistIndex = 0
+        elif i < self.playlistIndex:
+            self.playlistIndex -= 1
+        self.playlists.pop(i)
+
+    def on_library_change(self, action, playlistName, track=None, renamed=None):
+        """
+        Applies a single delta from the library watcher to the live playlists.
+        The queue keeps its order and the playing track is never touched.
+        """
+        if track is None:
+            self.on_playlist_change(action, playlistName, renamed)
+            return
+        playlist = self.find_playlist(playlistName)
+        if not playlist:
+            return
+        playing = self.player and playlist is self.playlists[self.playlistIndex]
+        if not playlist.is_loaded():
+            # the index catches up once the playlist is first loaded
+            if action == "add":
+                playlist.totalTracks += 1
+            elif action == "remove":
+                playlist.totalTracks = max(playlist.totalTracks - 1, 0)
+            return
+        tracks = playlist.tracks
+        table = playlist.table
+        # tracks still waiting in the shuffle only need their table slot updated
+        entryId = tracks.entry_of(track)
+        if action == "add":
+            if table.add(track) >= 0:
+                tracks.append(track)
+                playlist.totalTracks = table.live
+                print(f"Queued new track '{track}' in '{playlist.name}'")
+        elif action == "remove":
+            slot = table.remove(track)
+            if slot < 0:
+                return
+            playlist.totalTracks = table.live
+            if entryId:
+                if tracks.index_of(entryId) == 0 and playing:
+                    return  # let it finish, it's popped when it ends
+                tracks.remove_entry(entryId)
+            elif tracks.source:
+                tracks.source.discard(slot)
+                tracks.notify(track, False)
+            print(f"Removed '{track}' from '{playlist.name}'")
+        elif action == "rename":
+            table.rename(track, renamed)
+            if entryId:
+                tracks[tracks.index_of(entryId)] = renamed
+            elif tracks.source and tracks.source.has(renamed):
+                tracks.notify(track, False)
+                tracks.notify(renamed, True)
+
+    def on_playlist_change(self, action, name, renamed=None):
+        playlist = self.find_playlist(name)
+        if action == "add" and not playlist:
+            self.library.refresh_folder(name)
+            self.insert_playlist(
+                Playlist(name, self.library, self.library.count(name)))
+            print(f"Found new playlist '{name}'")
+        elif action == "remove" and playlist:
+            self.remove_playlist(name)
+            print(f"Playlist '{name}' was removed")
+        elif action == "rename" and playlist:
+            # back in its sorted place, the active playlist stays active
+            active = self.playlists[self.playlistIndex]
+            self.playlists.remove(playlist)
+            playlist.name = renamed
+            names = [p.name for p in self.playlists]
+            self.playlists.insert(bisect.bisect(names, renamed), playlist)
+            self.playlistIndex = self.playlists.index(active)
+            self.library.rename_folder(name, renamed)
+            print(f"Playlist '{name}' was renamed to '{renamed}'")
 
     def switch_playlists(self):
         if len(self.playlists) <= 1:
@@ -205,6 +507,7 @@ class MusicPlayer:
             self.playlistIndex += 1
         newPlaylist = self.playlists[self.playlistIndex].name
         print(f"Switched playlists from `{curPlaylist}` to `{newPlaylist}`")
+        self.playlists[self.playlistIndex].ensure_loaded()
         # print(self.player.playback_status())
         self.skip()
 
@@ -216,11 +519,12 @@ class MusicPlayer:
         # else: self.currentPlaylist += 1
         if index == self.playlistIndex:
             # reshuffle current playlist
-            self.playlists[index].load_tracks()
+            self.playlists[index].reshuffle()
             print(f"Reshuffled `{curPlaylist}`")
         else:
             self.playlistIndex = index
             newPlaylist = self.playlists[self.playlistIndex].name
+            self.playlists[index].ensure_loaded()
             print(
                 f"Switched playlists from `{curPlaylist}` to `{newPlaylist}`")
         # print(self.player.playback_status())
@@ -228,13 +532,25 @@ class MusicPlayer:
             self.skip()
 
     def on_player_stop(self, p, e):
+        self.stopTime = time.monotonic()
         if self.closed:
             print("Quitting the music player...")
+            self.drop_prefetched()
+            return
+        if not self.playlists:
+            # the last playlist folder was deleted while it played
+            print("No playlists left, stopping")
+            self.switching = False
+            self.stopTime = None
+            self.player = None
+            self.state.detach(p)
+            self.drop_prefetched()
+            self.snapshot.mark()
             return
         if not self.switching:
             # Exit status: {e}\n")
             print(
-                f"Ended: {self.playlists[self.playlistIndex].tracks.pop(0)}\n")
+                f"Ended: {self.playlists[self.playlistIndex].tracks.popleft()}\n")
         else:
             # Exit status: {e}\n")
             print(
@@ -243,8 +559,11 @@ class MusicPlayer:
         # self.playlists[self.currentPlaylist].tracks.pop(0)
         #if str(e) == '0': self.player.quit()
         self.player = None
+        self.state.detach(p)
+        self.snapshot.mark()
         if self.restart:
             self.restart = False
+            self.drop_prefetched()  # its audio output is being restarted too
             return
         if len(self.playlists[self.playlistIndex].tracks) > 0:
             if not self.closed:
@@ -253,7 +572,7 @@ class MusicPlayer:
         else:
             print("END OF PLAYLIST")
             if not self.closed:
-                self.playlists[self.playlistIndex].load_tracks()
+                self.playlists[self.playlistIndex].reshuffle()
                 self.create_player()
 
     # omxplayer -o alsa:pulse Prolly_w_music_YUNG_VAMP.mp3
@@ -262,13 +581,34 @@ class MusicPlayer:
         if self.player or self.closed:
             print("player already exists")
             return
+        if not self.playlists:
+            print("no playlists to play")
+            return
         curPlaylist = self.playlists[self.playlistIndex]
-        toPlay = f"{MUSIC_DIR}/{curPlaylist.name}/{curPlaylist.tracks[trackIndex]}"
+        toPlay = self.track_path(curPlaylist, curPlaylist.tracks[trackIndex])
+        args = ['-o', 'alsa:pulse', '--no-osd']
+        warm = None
+        startAt = 0
+        if self.resumePosition and trackIndex == 0:
+            startAt = self.resumePosition
+            # pick up the restored track where it was interrupted
+            args += ['--pos', time.strftime("%H:%M:%S", time.gmtime(self.resumePosition))]
+            self.drop_prefetched()
+        else:
+            warm = self.take_prefetched(toPlay)
+        self.resumePosition = 0
         try:
             print(toPlay)
-            player = OMXPlayer(toPlay,
-                               dbus_name=f"org.mpris.MediaPlayer2.omxplayer1",
-                               args=['-o', 'alsa:pulse', '--no-osd'])
+            if warm:
+                player = warm
+                # back to the start and full volume, it got some way in before pausing
+                player.set_position(0)
+                player.set_volume(1)
+                player.play()
+            else:
+                player = self.playerFactory(toPlay,
+                                            dbus_name=self.next_dbus_name(),
+                                            args=args)
             self.player = player
             self.player.exitEvent = self.on_player_stop
         except Exception as e:
@@ -280,14 +620,29 @@ class MusicPlayer:
             except KeyboardInterrupt:
                 print("Nevermind!")
             else:
+                self.snapshot.flush()
                 os.system("sudo reboot -h now")
         else:
             self.player = player
+            meta = self.metadata.get(toPlay)
+            self.state.attach(player, toPlay, meta.duration if meta else None, startAt)
+            self.snapshot.mark()
+            if self.stopTime is not None:
+                self.lastTransition = time.monotonic() - self.stopTime
+                self.stopTime = None
+                print(f"Track transition took {self.lastTransition * 1000:.0f} ms ({'prefetched' if warm else 'cold start'})")
             # print(self.player.volume())
             if not self.switching:
-                self.now = toPlay.split('/')[-1][:-4]
+                self.now = os.path.splitext(os.path.basename(toPlay))[0]
+                if self.onPlay:
+                    self.onPlay(toPlay)
+                # have the upcoming titles ready before the queue is opened
+                self.metadata.prefetch(self.track_path(curPlaylist, t)
+                                       for t in curPlaylist.tracks[trackIndex:trackIndex + 8])
                 print(
                     f"Now playing: {self.now} from '{curPlaylist.name}'({curPlaylist.totalTracks-len(curPlaylist.tracks)+1}/{curPlaylist.totalTracks})")
+                threading.Thread(target=self.prefetch_next,
+                                 args=(player,), daemon=True).start()
             else:
                 self.player.stop()
         #command = [f"omxplayer -o alsa:pulse {musicDir}/{track}"]
@@ -295,26 +650,84 @@ class MusicPlayer:
         # self.player = Popen(command, stdin=PIPE, stdout=PIPE,
         # close_fds=True, bufsize=0, shell=True)
 
-    def play(self, _input=None):
+    def next_dbus_name(self) -> str:
+        return f"org.mpris.MediaPlayer2.omxplayer{next(self.dbusIds)}"
+
+    def prefetch_next(self, player):
+        """Waits until `player` is about to finish, then loads the following track paused and muted"""
+        while self.player is player and not self.closed:
+            remaining = self.state.remaining()
+            if remaining is None:
+                # no length in the tags, ask omxplayer
+                self.state.sync()
+                remaining = self.state.remaining()
+            if remaining is None:
+                time.sleep(1)
+                continue
+            if remaining <= PREFETCH_LEAD:
+                break
+            # check again now and then in case of pauses and seeks
+            time.sleep(min(remaining - PREFETCH_LEAD, 5))
+        else:
+            return
+        if not self.playlists:
+            return
+        playlist = self.playlists[self.playlistIndex]
+        queue = playlist.tracks
+        if len(queue) < 2:
+            return  # the playlist gets reshuffled, the next track isn't known yet
+        path = self.track_path(playlist, queue[1])
+        with self.prefetchLock:
+            if self.nextPath == path:
+                return
+            self.drop_prefetched()
+            started = time.monotonic()
+            try:
+                self.nextPlayer = self.playerFactory(path, dbus_name=self.next_dbus_name(),
+                                                     args=['-o', 'alsa:pulse', '--no-osd',
+                                                           '--vol', str(PREFETCH_VOLUME)],
+                                                     pause=True)
+            except Exception as e:
+                print(f"Can't prefetch {path}: {e}")
+                return
+            self.nextPath = path
+        print(f"Prefetched next track in {(time.monotonic() - started) * 1000:.0f} ms")
+
+    def take_prefetched(self, path):
+        """Hands over the prefetched player if it holds `path`, a stale one is thrown away"""
+        with self.prefetchLock:
+            if self.nextPlayer and self.nextPath == path:
+                player = self.nextPlayer
+                self.nextPlayer = None
+                self.nextPath = None
+                return player
+            self.drop_prefetched()
+        return None
+
+    def drop_prefetched(self):
+        player, self.nextPlayer, self.nextPath = self.nextPlayer, None, None
+        if player:
+            try:
+                player.quit()
+            except Exception as e:
+                print(e)
+
+    def play(self):
+        if not self.playlists:
+            print("still scanning the library")
+            return
         if not self.player and len(self.playlists[self.playlistIndex].tracks) > 0:
-            if _input and os.path.exists('/dev/input/event0'):
-                if not _input.thread or not _input.thread.is_alive():
-                    _input.create_input_listener(True)
-                print("Created input listener!")
             print("Starting . . .")
             self.create_player()
 
-    def toggle_pause(self, _input=None):
+    def toggle_pause(self):
         if not self.player:
             print("player doesnt exist")
             return
-        if _input and os.path.exists('/dev/input/event0'):
-            if not _input.thread or not _input.thread.is_alive():
-                _input.create_input_listener(True)
-                print("Created input listener!")
         # print(self.player.volume())
         self.player.play_pause()
-        if self.player.playback_status() == "Paused":
+        self.snapshot.mark()
+        if self.state.toggle() == "Paused":
             print("❚❚")
         else:
             print("⏵︎")
@@ -322,11 +735,24 @@ class MusicPlayer:
         #self.player.communicate(input=bytes('p', 'utf-8'))
         # self.player.stdin.flush()
 
+    def restart_track(self):
+        if not self.player:
+            print("no player to restart")
+            return
+        try:
+            self.player.set_position(0)
+        except EnvironmentError as e:
+            print(f"Can't restart {self.now}: {e}")
+        else:
+            self.state.seek(0)
+            self.snapshot.mark()
+            print(f"Restarting: {self.now}")
+
     def skip(self):
         if not self.player:
             print("no player to skip")
             return
-        curTrack = self.playlists[self.playlistIndex].tracks[0]
+        curTrack = self.playlists[self.playlistIndex].tracks[0] if self.playlists else self.now
         try:
             self.player.stop()
         except EnvironmentError as e:
@@ -347,20 +773,23 @@ if __name__ == '__main__':
         debug = False
 
     hack = BTHack()
-    if not os.path.exists('/dev/input/event0') and not hack.initiate():
+    # only repairs what's broken, a working setup goes straight through
+    if not hack.initiate():
         print(f"\n\nCan't launch!")
         exit()
 
     music = MusicPlayer()
+    music.resume_playback()
     manager: InputManager = InputManager(music)
     try:
-        status = manager.listener()
+        manager.keys.thread.join()
     except KeyboardInterrupt:
         print("oh no!")
     except Exception as e:
         print(e)
     finally:
         print("i sleep now")
+        music.snapshot.flush()
         music.closed = True
         exit()
     # while True:
@@ -0,0 +1,134 @@
+import time
+import threading
+
+
+class PlayerState:
+    """
+    Last known state of the current omxplayer, so the menus never wait on D-Bus.
+
+    It's updated from the commands the music player sends and from the exit
+    event, the position is worked out from the monotonic clock while playing.
+    A background thread asks omxplayer for the real values every `interval`
+    seconds to correct any drift.
+
+    Attributes:
+        `status`        `Playing`, `Paused` or `Stopped`\n
+        `source`        Path of the loaded track (or None)\n
+        `duration`      Length of the track in seconds (or None until known)\n
+        `interval`      Seconds between syncs with the player
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.player = None
+        self.status = "Stopped"
+        self.source = None
+        self.duration = None
+        # position at the time of the last update, playing moves it on from there
+        self.anchor = 0.0
+        self.anchorTime = time.monotonic()
+        self.syncs = 0
+        self.syncedAt = 0.0  # monotonic time of the last sync
+        self.thread = None
+        self.shouldDie = False
+
+    def attach(self, player, source, duration=None, position=0.0, status="Playing") -> None:
+        """A new player took over"""
+        with self.lock:
+            self.player = player
+            self.source = source
+            self.duration = duration
+            self.status = status
+            self.anchor = position
+            self.anchorTime = time.monotonic()
+        if duration is None:
+            # omxplayer needs a moment before it knows the length
+            timer = threading.Timer(1, self.sync)
+            timer.daemon = True
+            timer.start()
+
+    def detach(self, player=None) -> None:
+        """The player quit, `player` guards against a late exit of an older one"""
+        with self.lock:
+            if player is not None and player is not self.player:
+                return
+            self.player = None
+            self.status = "Stopped"
+            self.anchor = 0.0
+
+    def set_status(self, status) -> None:
+        with self.lock:
+            self.anchor = self._position()
+            self.anchorTime = time.monotonic()
+            self.status = status
+
+    def seek(self, position) -> None:
+        """Mirrors a `set_position` command"""
+        with self.lock:
+            self.anchor = position
+            self.anchorTime = time.monotonic()
+
+    def toggle(self) -> str:
+        """Mirrors a `play_pause` command, returns the new status"""
+        self.set_status("Paused" if self.status == "Playing" else "Playing")
+        return self.status
+
+    def is_playing(self) -> bool:
+        return self.status == "Playing"
+
+    def position(self) -> float:
+        with self.lock:
+            return self._position()
+
+    def remaining(self):
+        """Seconds left in the track, or None if the length isn't known"""
+        with self.lock:
+            if self.duration is None:
+                return None
+            return self.duration - self._position()
+
+    def _position(self) -> float:
+        position = self.anchor
+        if self.status == "Playing":
+            position += time.monotonic() - self.anchorTime
+        if self.duration is not None:
+            position = min(position, self.duration)
+        return position
+
+    def sync(self):
+        """Asks omxplayer for the real state, returns the position while playing, otherwise None"""
+        player = self.player
+        if not player:
+            return None
+        try:
+            status = player.playback_status()
+            position = player.position()
+            duration = self.duration or player.duration()
+        except Exception:
+            return None  # quitting, the exit event will clear it
+        with self.lock:
+            if self.player is not player:
+                return None
+            self.status = status
+            self.anchor = position
+            self.anchorTime = time.monotonic()
+            self.duration = duration
+            self.syncs += 1
+            self.syncedAt = time.monotonic()
+        return position if status == "Playing" else None
+
+    def start(self) -> None:
+        if self.thread and self.thread.is_alive():
+            return
+        self.shouldDie = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.shouldDie = True
+
+    def run(self) -> None:
+        while not self.shouldDie:
+            time.sleep(self.interval)
+            self.sync()
@@ -0,0 +1,359 @@
+import random
+import itertools
+import threading
+
+
+class _Node:
+    __slots__ = ("value", "id", "prio", "size", "left", "right", "parent")
+
+    def __init__(self, value, entryId):
+        self.value = value
+        self.id = entryId
+        self.prio = random.random()
+        self.size = 1
+        self.left = None
+        self.right = None
+        self.parent = None
+
+
+def _size(node) -> int:
+    return node.size if node else 0
+
+
+def _update(node) -> None:
+    node.size = 1 + _size(node.left) + _size(node.right)
+    if node.left:
+        node.left.parent = node
+    if node.right:
+        node.right.parent = node
+
+
+def _merge(a, b):
+    """Joins two trees, every node of `a` ends up before every node of `b`"""
+    if not a:
+        return b
+    if not b:
+        return a
+    if a.prio > b.prio:
+        a.right = _merge(a.right, b)
+        _update(a)
+        return a
+    b.left = _merge(a, b.left)
+    _update(b)
+    return b
+
+
+def _split(node, k) -> tuple:
+    """Cuts a tree into its first `k` nodes and the rest"""
+    if not node:
+        return None, None
+    if _size(node.left) >= k:
+        left, node.left = _split(node.left, k)
+        _update(node)
+        if left:
+            left.parent = None
+        return left, node
+    node.right, right = _split(node.right, k - _size(node.left) - 1)
+    _update(node)
+    if right:
+        right.parent = None
+    return node, right
+
+
+def _root(node):
+    if node:
+        node.parent = None
+    return node
+
+
+def _node_at(node, i):
+    while True:
+        leftSize = _size(node.left)
+        if i < leftSize:
+            node = node.left
+        elif i == leftSize:
+            return node
+        else:
+            i -= leftSize + 1
+            node = node.right
+
+
+def _iter_nodes(node):
+    stack = []
+    while stack or node:
+        while node:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        yield node
+        node = node.right
+
+
+class PlayQueue:
+    """
+    Ordered track queue backed by an implicit treap (a randomly balanced binary tree
+    ordered by position), so popping the head, moving, removing and looking up any
+    entry all take O(log n) instead of shifting a whole list.
+
+    Every entry gets a stable id when queued, menus hold on to the id instead of
+    an index so they stay valid while the queue changes underneath them.
+
+    The queue can be fed by a lazy `source` (see `modules.shuffle.ShuffleSource`):
+    its tracks count towards the queue but only become real entries once
+    something reaches that far into the queue. `values` are queued in front of
+    the source, appended tracks go after it.
+
+    Behaves like a list of track names for reading, `insert`, `append` and `pop`.
+    Track names are expected to be unique within a queue.
+
+    `onChange` is called with `(track, True)` when a track joins the queue and
+    `(track, False)` when it leaves it, drawing from the source doesn't count.
+    """
+
+    def __init__(self, values=(), source=None):
+        self.root = None  # entries in front of the source
+        self.tail = None  # entries appended behind the source
+        self.source = source
+        self.nodes = {}  # entry id -> node
+        self.byValue = {}  # track name -> entry id
+        self.ids = itertools.count(1)  # ids are truthy, Button skips falsy args
+        self.lock = threading.RLock()
+        self.onChange = None
+        self.root = _root(self._build(values))
+
+    def __len__(self) -> int:
+        return _size(self.root) + self._pending() + _size(self.tail)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __iter__(self):
+        for _, value in self.entries():
+            yield value
+
+    def __contains__(self, value) -> bool:
+        return value in self.byValue or bool(self.source and self.source.has(value))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        with self.lock:
+            region, i = self._locate(i)
+            return _node_at(getattr(self, region), i).value
+
+    def __setitem__(self, i, value) -> None:
+        with self.lock:
+            region, i = self._locate(i)
+            node = _node_at(getattr(self, region), i)
+            del self.byValue[node.value]
+            self.notify(node.value, False)
+            node.value = value
+            self.byValue[value] = node.id
+            self.notify(value, True)
+
+    def __repr__(self):
+        return f"PlayQueue({list(self)!r})"
+
+    def entries(self):
+        """Yields `(entry id, track)` pairs from the head of the queue, drawing the whole source"""
+        with self.lock:
+            self._fill(len(self))
+            nodes = list(_iter_nodes(self.root)) + list(_iter_nodes(self.tail))
+        for node in nodes:
+            yield node.id, node.value
+
+    def entry_id(self, i) -> int:
+        with self.lock:
+            region, i = self._locate(i)
+            return _node_at(getattr(self, region), i).id
+
+    def entry(self, i) -> tuple:
+        """`(entry id, track)` at position `i`"""
+        with self.lock:
+            region, i = self._locate(i)
+            node = _node_at(getattr(self, region), i)
+            return node.id, node.value
+
+    def index_of(self, entryId) -> int:
+        """Current position of an entry, or -1 if it has left the queue"""
+        node = self.nodes.get(entryId)
+        if not node:
+            return -1
+        with self.lock:
+            i = _size(node.left)
+            while node.parent:
+                if node is node.parent.right:
+                    i += _size(node.parent.left) + 1
+                node = node.parent
+            if node is self.tail:
+                i += _size(self.root) + self._pending()
+            return i
+
+    def entry_of(self, value) -> int:
+        """Entry id of a queued track, 0 if it's not queued or still waiting in the source"""
+        return self.byValue.get(value, 0)
+
+    def index(self, value) -> int:
+        with self.lock:
+            if value not in self.byValue and self.source and self.source.has(value):
+                # draw the source up to the track so it gets an entry
+                pos = self.source.position(self.source.table.slot(value))
+                self._fill(_size(self.root) + pos - self.source.cursor + 1)
+            if value not in self.byValue:
+                raise ValueError(f"{value!r} is not queued")
+            return self.index_of(self.byValue[value])
+
+    def insert(self, i, value) -> int:
+        """Queues a track at position `i` and returns its entry id"""
+        with self.lock:
+            node = self._new(value)
+            self._put(node, i)
+            self.notify(value, True)
+            return node.id
+
+    def append(self, value) -> int:
+        with self.lock:
+            node = self._new(value)
+            self.tail = _root(_merge(self.tail, node))
+            self.notify(value, True)
+            return node.id
+
+    def extend(self, values) -> None:
+        with self.lock:
+            values = list(values)
+            self.tail = _root(_merge(self.tail, self._build(values)))
+            for value in values:
+                self.notify(value, True)
+
+    def pop(self, i=-1):
+        with self.lock:
+            node = self._take(i)
+            del self.nodes[node.id]
+            del self.byValue[node.value]
+            self.notify(node.value, False)
+            return node.value
+
+    def popleft(self):
+        return self.pop(0)
+
+    def remove_entry(self, entryId):
+        i = self.index_of(entryId)
+        if i < 0:
+            raise KeyError(entryId)
+        return self.pop(i)
+
+    def move(self, i, j) -> None:
+        """Moves the entry at position `i` so it ends up at position `j`, keeping its id"""
+        with self.lock:
+            self._put(self._take(i), j)
+
+    def clear(self) -> None:
+        with self.lock:
+            if self.onChange:
+                for value in self.members():
+                    self.notify(value, False)
+            self.root = None
+            self.tail = None
+            self.source = None
+            self.nodes = {}
+            self.byValue = {}
+
+    def members(self):
+        """Every queued track in no particular order, without drawing the source"""
+        with self.lock:
+            values = list(self.byValue)
+            if self.source:
+                values.extend(self.source.pending())
+        return values
+
+    def notify(self, value, queued) -> None:
+        if self.onChange:
+            self.onChange(value, queued)
+
+    def state(self) -> dict:
+        """Queue order in a form that fits in a snapshot without drawing the source"""
+        with self.lock:
+            return {"head": [n.value for n in _iter_nodes(self.root)],
+                    "source": self.source.state() if self.source else None,
+                    "tail": [n.value for n in _iter_nodes(self.tail)]}
+
+    # internals
+
+    def _new(self, value):
+        node = _Node(value, next(self.ids))
+        self.nodes[node.id] = node
+        self.byValue[value] = node.id
+        return node
+
+    def _pending(self) -> int:
+        return len(self.source) if self.source else 0
+
+    def _fill(self, k) -> None:
+        """Draws tracks from the source until the head holds `k` entries"""
+        while self.source and _size(self.root) < k:
+            value = self.source.next()
+            if value is None:
+                break
+            self.root = _root(_merge(self.root, self._new(value)))
+
+    def _locate(self, i) -> tuple:
+        """Turns a queue position into (`root` or `tail`, position inside that tree)"""
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("queue index out of range")
+        if i >= _size(self.root) + self._pending():
+            return "tail", i - _size(self.root) - self._pending()
+        self._fill(i + 1)
+        return "root", i
+
+    def _take(self, i):
+        region, i = self._locate(i)
+        left, rest = _split(getattr(self, region), i)
+        node, right = _split(rest, 1)
+        setattr(self, region, _root(_merge(left, right)))
+        return node
+
+    def _put(self, node, i) -> None:
+        i = max(0, min(i, len(self)))
+        head, pending = _size(self.root), self._pending()
+        if i > head and i >= head + pending:
+            # behind the source, no need to draw it
+            region = "tail"
+            i -= head + pending
+        else:
+            self._fill(i)
+            region = "root"
+        left, right = _split(getattr(self, region), i)
+        setattr(self, region, _root(_merge(_merge(left, node), right)))
+
+    def _build(self, values):
+        """Builds a treap from an ordered sequence in O(n) with a right-spine stack"""
+        spine = []
+        for value in values:
+            node = self._new(value)
+            last = None
+            while spine and spine[-1].prio < node.prio:
+                last = spine.pop()
+            node.left = last
+            if last:
+                last.parent = node
+            if spine:
+                spine[-1].right = node
+                node.parent = spine[-1]
+            spine.append(node)
+        root = spine[0] if spine else None
+        # fix up the subtree sizes, parents are listed before their children
+        stack = [root] if root else []
+        order = []
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if node.left:
+                stack.append(node.left)
+            if node.right:
+                stack.append(node.right)
+        for node in reversed(order):
+            node.size = 1 + _size(node.left) + _size(node.right)
+        return root
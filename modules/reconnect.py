@@ -0,0 +1,184 @@
+import time
+import random
+import threading
+import dbus
+from modules.bluetooth import BLUEZ, ADAPTER, PROPERTIES, pactl, wait_for
+
+
+class Reconnector:
+    """
+    Gets the speaker back as soon as it's in reach again after it dropped.
+
+    It follows the speaker's `Connected` property through the `DeviceRegistry`
+    and the adapter's power through BlueZ's signals. When the link drops the
+    music is paused and the speaker is retried right away, then with capped
+    exponential backoff and some jitter. Any sign of the speaker or the adapter
+    coming back cuts the wait short. Once it's connected again, playback
+    resumes as soon as PulseAudio has the speaker's sink.
+
+    Attributes:
+        `music`         The `MusicPlayer` to pause and resume\n
+        `bluez`         The `BlueZ` client\n
+        `registry`      Optional `DeviceRegistry` telling about the speaker, without it the link is polled\n
+        `pollInterval`  Seconds between checks of the link without a registry\n
+        `base`          Seconds to wait after the first failed attempt, doubled after every one\n
+        `cap`           Longest wait between attempts\n
+        `sinkTimeout`   Seconds to wait for the PulseAudio sink after connecting
+    """
+
+    def __init__(self, music, bluez, registry=None, pollInterval=5, base=1, cap=60, sinkTimeout=20):
+        self.music = music
+        self.bluez = bluez
+        self.polled = registry is None
+        self.pollInterval = pollInterval
+        self.poller = None
+        self.base = base
+        self.cap = cap
+        self.sinkTimeout = sinkTimeout
+        self.cond = threading.Condition()
+        self.mac = None  # the speaker to keep connected
+        self.connected = False
+        self.droppedAt = None  # set while reconnecting
+        self.woken = False
+        self.wasPlaying = False
+        self.attempts = 0
+        self.restores = []  # seconds every reconnect took
+        if registry:
+            registry.watch(self.on_device)
+        bluez.subscribe(lambda bus: bus.add_signal_receiver(self.on_adapter, "PropertiesChanged", PROPERTIES,
+                                                            BLUEZ, arg0=ADAPTER))
+
+    def follow(self, mac) -> None:
+        """Keeps the connected speaker `mac` connected from now on, None stops reconnecting"""
+        with self.cond:
+            self.mac = mac.upper() if mac else None
+            self.connected = mac is not None
+            self.droppedAt = None
+            self.cond.notify_all()
+        if self.polled and mac:
+            self.start_polling()
+
+    def start_polling(self) -> None:
+        if self.poller and self.poller.is_alive():
+            return
+        self.poller = threading.Thread(target=self.poll, daemon=True)
+        self.poller.start()
+
+    def poll(self) -> None:
+        """Asks BlueZ about the speaker every `pollInterval` seconds until it's no longer followed"""
+        while True:
+            time.sleep(self.pollInterval)
+            with self.cond:
+                mac = self.mac
+                if mac is None:
+                    return
+                if self.droppedAt is not None:
+                    continue  # the reconnect loop has it
+            if not self.bluez.is_connected(mac):
+                with self.cond:
+                    if self.mac != mac:
+                        continue
+                self.dropped()
+
+    def on_device(self, device, present) -> None:
+        # runs on the D-Bus thread, nothing here may block
+        with self.cond:
+            if self.mac is None or device["mac"].upper() != self.mac:
+                return
+            connected = present and device["connected"]
+            if connected == self.connected:
+                self.woken = True  # heard from it, e.g. a new RSSI while scanning
+                self.cond.notify_all()
+                return
+            self.connected = connected
+            self.cond.notify_all()
+        if not connected:
+            self.dropped()
+
+    def on_adapter(self, interface, changed, invalidated) -> None:
+        if changed.get("Powered"):
+            with self.cond:
+                self.woken = True
+                self.cond.notify_all()
+
+    def dropped(self) -> None:
+        """The speaker went away, pauses the music and starts getting it back"""
+        with self.cond:
+            mac = self.mac
+            if self.droppedAt is not None:
+                return  # already on it
+            self.connected = False
+            self.droppedAt = droppedAt = time.monotonic()
+            self.woken = False
+        # passed along, `follow` resets the attribute when the speaker gets connected from the menu
+        threading.Thread(target=self.run, args=(mac, droppedAt), daemon=True).start()
+
+    def run(self, mac, droppedAt) -> None:
+        if self.music.player and self.music.state.is_playing():
+            try:
+                self.music.toggle_pause()
+            except Exception as e:
+                print(e)
+            else:
+                self.wasPlaying = True
+                print("Paused music (disconnected)")
+        if mac is None:
+            with self.cond:
+                if self.droppedAt == droppedAt:
+                    self.droppedAt = None
+            return
+        print("Trying to reconnect speaker...")
+        delay = self.base
+        attempt = 0
+        while True:
+            with self.cond:
+                if self.mac != mac:
+                    return  # another speaker was picked or it was disconnected on purpose
+                connected = self.connected
+            if connected or self.bluez.is_connected(mac):
+                break
+            attempt += 1
+            self.attempts += 1
+            try:
+                self.bluez.connect(mac)
+            except dbus.exceptions.DBusException as e:
+                print(f"Reconnect attempt {attempt} failed: {e.get_dbus_name()}")
+            else:
+                break
+            # jitter keeps the retries from lining up with the speaker's own
+            wait = delay * random.uniform(0.5, 1)
+            delay = min(delay * 2, self.cap)
+            with self.cond:
+                self.cond.wait_for(lambda: self.woken or self.connected or self.mac != mac, wait)
+                self.woken = False
+        restored = time.monotonic() - droppedAt
+        with self.cond:
+            self.connected = True
+            if self.droppedAt == droppedAt:
+                self.droppedAt = None
+        self.restores.append(restored)
+        print(f"Restored bluetooth connection after {restored:.1f}s and {attempt} attempts!")
+        # PulseAudio needs a moment to put the speaker's sink up
+        sink = f"bluez_sink.{mac.replace(':', '_')}"
+        if not wait_for(lambda: sink in (pactl("list", "sinks", "short") or ""), self.sinkTimeout):
+            print("The speaker's sink never showed up")
+            return
+        if self.wasPlaying and self.music.player and not self.music.state.is_playing():
+            self.wasPlaying = False
+            try:
+                self.music.toggle_pause()
+            except Exception as e:
+                print(e)
+            else:
+                print("Resuming playback.")
+
+    def stats(self) -> dict:
+        return {"attempts": self.attempts,
+                "restores": len(self.restores),
+                "averageRestore": sum(self.restores) / len(self.restores) if self.restores else 0,
+                "maxRestore": max(self.restores, default=0)}
+
+    def report(self) -> str:
+        s = self.stats()
+        return (f"{s['restores']} reconnects in {s['attempts']} attempts, "
+                f"{s['averageRestore']:.1f}s average and {s['maxRestore']:.1f}s max to restore")
@@ -0,0 +1,105 @@
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from modules.iosched import IOScheduler
+
+# formats omxplayer can decode
+AUDIO_EXTENSIONS = {".mp3", ".m4a", ".aac", ".flac", ".ogg", ".opus", ".wav"}
+
+
+def is_audio(name) -> bool:
+    # skips the ._song.mp3 resource forks macOS leaves on usb sticks
+    return not name.startswith('.') and os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS
+
+
+def list_dir(path) -> tuple:
+    """Returns the sorted audio files and visible subfolders of a directory"""
+    files = []
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.name.startswith('.'):
+                    subdirs.append(entry.name)
+            elif is_audio(entry.name):
+                files.append(entry.name)
+    return sorted(files), sorted(subdirs)
+
+
+class LibraryScanner:
+    """
+    Recursively walks playlist folders with a bounded pool of threads, so the
+    latency of slow usb sticks and sd cards overlaps instead of adding up.
+
+    Attributes:
+        `root`          Parent directory of the playlist folders\n
+        `lister`        Callback taking a path relative to `root` and returning
+        `(mtime, files, subdirs, changed)`, defaults to listing the disk\n
+        `workers`       Maximum number of directories read at the same time
+
+        `scheduler`     `IOScheduler` the workers and directory listings go through,
+        unthrottled if None
+    """
+
+    def __init__(self, root, lister=None, workers=4, scheduler=None):
+        self.root = root
+        self.lister = lister or self.list_disk
+        self.workers = workers
+        self.scheduler = scheduler or IOScheduler(rate=0, idle=False)
+
+    def list_disk(self, path) -> tuple:
+        full = f"{self.root}/{path}"
+        mtime = os.stat(full).st_mtime  # before listing, so a racing change is caught next time
+        self.scheduler.acquire()
+        files, subdirs = list_dir(full)
+        return mtime, files, subdirs, True
+
+    def scan(self, playlists, on_dir=None, on_playlist=None) -> None:
+        """
+        Walks every folder in `playlists` concurrently.\n
+        `on_dir(path, mtime, files, subdirs, changed)` is called for each directory read\n
+        `on_playlist(name, tracks, changed)` is called as soon as the whole tree of a playlist
+        is done, with track paths relative to the playlist folder
+        """
+        pending = {}  # future -> (playlist, relative path)
+        remaining = {}  # directories left to read per playlist
+        found = {}  # playlist -> {subfolder: files}
+        changed = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers, initializer=self.scheduler.worker_init) as pool:
+            def submit(playlist, path):
+                remaining[playlist] += 1
+                pending[pool.submit(self.lister, path)] = (playlist, path)
+
+            for name in playlists:
+                remaining[name] = 0
+                found[name] = {}
+                changed[name] = False
+                submit(name, name)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    playlist, path = pending.pop(future)
+                    remaining[playlist] -= 1
+                    try:
+                        mtime, files, subdirs, listed = future.result()
+                    except (OSError, sqlite3.Error) as e:
+                        # folder vanished, the stick was pulled or the index hiccuped, skip that branch
+                        print(f"Can't scan {path}: {e}")
+                        changed[playlist] = True
+                    else:
+                        if on_dir:
+                            on_dir(path, mtime, files, subdirs, listed)
+                        changed[playlist] = changed[playlist] or listed
+                        found[playlist][path[len(playlist) + 1:]] = files
+                        for s in subdirs:
+                            submit(playlist, f"{path}/{s}")
+                    if remaining[playlist] == 0 and on_playlist:
+                        folders = found.pop(playlist)
+                        tracks = []
+                        for folder in sorted(folders):
+                            prefix = f"{folder}/" if folder else ""
+                            tracks.extend(prefix + f for f in folders[folder])
+                        on_playlist(playlist, tracks, changed[playlist])
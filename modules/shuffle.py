@@ -0,0 +1,184 @@
+import zlib
+import random
+
+
+def _mix(x) -> int:
+    # 32 bit integer hash, stable across runs unlike hash()
+    x = ((x ^ (x >> 16)) * 0x45d9f3b) & 0xFFFFFFFF
+    x = ((x ^ (x >> 16)) * 0x45d9f3b) & 0xFFFFFFFF
+    return x ^ (x >> 16)
+
+
+class FeistelPermutation:
+    """
+    Seeded bijection over `[0, n)` computed one index at a time.
+
+    A small Feistel network shuffles the bits of an index inside the smallest
+    power-of-four range holding `n`, results outside `[0, n)` are fed back in
+    (cycle walking) until they land inside it. Nothing is stored per element.
+    """
+
+    def __init__(self, n, seed, rounds=6):
+        self.n = n
+        bits = max(2, (n - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+        self.keys = [_mix((seed + r * 0x9E3779B9) & 0xFFFFFFFF) for r in range(rounds)]
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, i) -> int:
+        if not 0 <= i < self.n:
+            raise IndexError("permutation index out of range")
+        x = self._encrypt(i)
+        while x >= self.n:
+            x = self._encrypt(x)
+        return x
+
+    def inverse(self, x) -> int:
+        """Returns the position `i` that maps onto `x`"""
+        i = self._decrypt(x)
+        while i >= self.n:
+            i = self._decrypt(i)
+        return i
+
+    def _encrypt(self, x) -> int:
+        left, right = x >> self.half, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix(right ^ key) & self.mask)
+        return (left << self.half) | right
+
+    def _decrypt(self, x) -> int:
+        left, right = x >> self.half, x & self.mask
+        for key in reversed(self.keys):
+            left, right = right ^ (_mix(left ^ key) & self.mask), left
+        return (left << self.half) | right
+
+
+class TrackTable:
+    """
+    Unshuffled track list of a playlist, the order it's stored in the library index.
+    Removed tracks leave an empty slot behind so the slots of the others never move.
+    """
+
+    def __init__(self, tracks):
+        self.tracks = list(tracks)
+        self.live = len(self.tracks)
+        self.slots = None  # track -> slot, built on first lookup
+        self.crc = None
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def __getitem__(self, slot):
+        return self.tracks[slot]
+
+    def slot(self, track) -> int:
+        if self.slots is None:
+            self.slots = {t: i for i, t in enumerate(self.tracks) if t is not None}
+        return self.slots.get(track, -1)
+
+    def checksum(self) -> int:
+        """Identifies the exact slot layout, a shuffle can only be resumed on the same one"""
+        if self.crc is None:
+            self.crc = zlib.crc32("\0".join(t or "" for t in self.tracks).encode())
+        return self.crc
+
+    def add(self, track) -> int:
+        if self.slot(track) >= 0:
+            return -1
+        self.tracks.append(track)
+        self.crc = None
+        self.slots[track] = len(self.tracks) - 1
+        self.live += 1
+        return len(self.tracks) - 1
+
+    def remove(self, track) -> int:
+        slot = self.slot(track)
+        if slot >= 0:
+            self.tracks[slot] = None
+            self.crc = None
+            del self.slots[track]
+            self.live -= 1
+        return slot
+
+    def rename(self, track, renamed) -> int:
+        slot = self.slot(track)
+        if slot >= 0:
+            self.tracks[slot] = renamed
+            self.crc = None
+            del self.slots[track]
+            self.slots[renamed] = slot
+        return slot
+
+
+class ShuffleSource:
+    """
+    Hands out the tracks of a `TrackTable` in a seeded random order, one at a time.
+
+    Only the seed and a cursor are kept, so starting a new shuffle is O(1) no
+    matter how big the playlist is, and the same seed and cursor always pick up
+    the exact same order again. Tracks added to the table after the shuffle
+    started are not part of it.
+
+    Attributes:
+        `table`         The `TrackTable` to draw tracks from\n
+        `seed`          Seed of the permutation, random if None\n
+        `cursor`        How many positions of the permutation were already handed out
+    """
+
+    def __init__(self, table, seed=None, cursor=0):
+        self.table = table
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.size = len(table)
+        self.perm = FeistelPermutation(self.size, self.seed)
+        self.cursor = cursor
+        # slots emptied before the cursor reached them
+        if cursor == 0:
+            self.dropped = self.size - table.live
+        else:
+            self.dropped = sum(1 for i, t in enumerate(table.tracks)
+                               if t is None and self.perm.inverse(i) >= cursor)
+
+    def __len__(self) -> int:
+        return self.size - self.cursor - self.dropped
+
+    def next(self):
+        """Returns the next track, or None once every track was handed out"""
+        while self.cursor < self.size:
+            track = self.table[self.perm[self.cursor]]
+            self.cursor += 1
+            if track is not None:
+                return track
+            self.dropped -= 1
+        return None
+
+    def position(self, slot) -> int:
+        """Permutation position of a table slot, or -1 if it was already handed out"""
+        if not 0 <= slot < self.size:
+            return -1
+        pos = self.perm.inverse(slot)
+        return pos if pos >= self.cursor else -1
+
+    def pending(self):
+        """Tracks that weren't handed out yet, in table order"""
+        tracks = self.table.tracks[:self.size]
+        if self.cursor < self.size // 2:
+            # cheaper to work out the few slots already handed out
+            taken = {self.perm[i] for i in range(self.cursor)}
+            return [t for i, t in enumerate(tracks) if t is not None and i not in taken]
+        return [t for i, t in enumerate(tracks)
+                if t is not None and self.perm.inverse(i) >= self.cursor]
+
+    def has(self, track) -> bool:
+        return self.position(self.table.slot(track)) >= 0
+
+    def discard(self, slot) -> None:
+        """Called after a table slot was emptied, keeps the remaining count right"""
+        if self.position(slot) >= 0:
+            self.dropped += 1
+
+    def state(self) -> dict:
+        return {"seed": self.seed, "cursor": self.cursor, "size": self.size,
+                "checksum": self.table.checksum()}
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import threading
+
+# next to main.py like the library index
+STATE_FILE = os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), "playback.json")
+
+
+class PlaybackSnapshot:
+    """
+    Keeps a small file describing what is playing, so a crash or a power cut
+    resumes the same queue at the same spot instead of starting over.
+
+    Writes go to a temporary file that is synced and renamed over the old one,
+    so the snapshot on disk is always complete. Requests to save are coalesced
+    so the sd card sees at most one write every `minGap` seconds, and a snapshot
+    that says the same as the last one written is skipped. Only a playing track
+    moves on, so while nothing plays the periodic snapshots don't touch the card.
+
+    Attributes:
+        `collect`       Callback returning the snapshot as a dict, or None to skip the write\n
+        `path`          Location of the snapshot file\n
+        `interval`      Seconds between periodic snapshots\n
+        `minGap`        Minimum seconds between two writes
+    """
+
+    def __init__(self, collect, path=STATE_FILE, interval=5, minGap=1):
+        self.collect = collect
+        self.path = path
+        self.interval = interval
+        self.minGap = minGap
+        self.lastWrite = 0
+        self.lastSaved = None  # what the file on disk says, as compared by `comparable`
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.shouldDie = False
+
+    def load(self):
+        """Returns the last snapshot, or None if there is no usable one"""
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring playback snapshot: {e}")
+            return None
+
+    def start(self) -> None:
+        if self.thread and self.thread.is_alive():
+            return
+        self.shouldDie = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.shouldDie = True
+        self.wake.set()
+
+    def mark(self) -> None:
+        """Asks for a snapshot as soon as the write limit allows, e.g. on track change"""
+        self.wake.set()
+
+    def flush(self) -> None:
+        """Writes a snapshot right away, used before the process goes down"""
+        self.save()
+
+    def run(self) -> None:
+        while not self.shouldDie:
+            self.wake.wait(self.interval)
+            wait = self.lastWrite + self.minGap - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)  # later marks get folded into this write
+            self.wake.clear()
+            if not self.shouldDie:
+                self.save()
+        self.save()
+
+    def save(self) -> None:
+        try:
+            data = self.collect()
+        except Exception as e:
+            print(f"Can't collect playback snapshot: {e}")
+            return
+        if data is None:
+            return
+        saved = self.comparable(data)
+        with self.lock:
+            if saved == self.lastSaved:
+                return
+            self.lastWrite = time.monotonic()
+            try:
+                self.write(data)
+            except OSError as e:
+                print(f"Can't write playback snapshot: {e}")
+            else:
+                self.lastSaved = saved
+
+    @staticmethod
+    def comparable(data) -> dict:
+        """What tells two snapshots apart, not the time they were taken nor the position while stopped"""
+        saved = {key: value for key, value in data.items() if key != "time"}
+        if not data.get("playing"):
+            saved.pop("position", None)
+        return saved
+
+    def write(self, data) -> None:
+        temp = f"{self.path}.tmp"
+        with open(temp, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        # the rename itself only survives a power cut once the directory is synced
+        fd = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,250 @@
+import os
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import threading
+
+from modules.scanner import is_audio
+
+# flags from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class LibraryWatcher:
+    """
+    Background thread reporting changes inside the music directory as deltas.
+
+    Uses inotify on every folder of the library when the kernel supports it,
+    otherwise periodically runs an incremental index refresh, which only
+    re-lists the directories whose mtime changed, and diffs the results.
+
+    Attributes:
+        `root`          Parent directory of the playlist folders\n
+        `library`       `LibraryIndex` used as the previous state of the library\n
+        `handler`       Callback taking `(action, playlist, track, renamed)` where
+        action is `add`, `remove` or `rename` and `track` is None for playlist changes.
+        Tracks are paths relative to the playlist folder\n
+        `interval`      Seconds between polls for the fallback watcher
+    """
+
+    def __init__(self, root, library, handler, interval=30):
+        self.root = root
+        self.library = library
+        self.handler = handler
+        self.interval = interval
+        self.thread = None
+        self.shouldDie = False
+        self.mode = None
+        self.libc = None
+        self.fd = None
+        self.watches = {}  # watch descriptor -> (playlist, folder inside the playlist)
+
+    def start(self) -> None:
+        if self.thread and self.thread.is_alive():
+            return
+        self.shouldDie = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.shouldDie = True
+
+    def run(self) -> None:
+        try:
+            self.watch_inotify()
+        except OSError as e:
+            print(f"inotify unavailable ({e}), polling the library instead")
+            self.watch_polling()
+
+    def emit(self, action, playlist, track=None, renamed=None) -> None:
+        try:
+            self.handler(action, playlist, track, renamed)
+        except Exception as e:
+            print(f"Library update failed: {e}")
+
+    # inotify backend
+
+    def add_watch(self, playlist, folder) -> None:
+        path = self.root
+        if playlist is not None:
+            path = f"{self.root}/{playlist}/{folder}" if folder else f"{self.root}/{playlist}"
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"can't watch {path}")
+        self.watches[wd] = (playlist, folder)
+
+    def watch_tree(self, playlist, folder) -> list:
+        """Watches a folder and everything below it, returns the audio files found"""
+        tracks = []
+        self.add_watch(playlist, folder)
+        base = f"{self.root}/{playlist}"
+        for path, subdirs, files in os.walk(f"{base}/{folder}" if folder else base):
+            subdirs[:] = [d for d in subdirs if not d.startswith('.')]
+            rel = os.path.relpath(path, base)
+            rel = "" if rel == "." else rel
+            for d in subdirs:
+                self.add_watch(playlist, f"{rel}/{d}" if rel else d)
+            tracks.extend(f"{rel}/{f}" if rel else f for f in sorted(files) if is_audio(f))
+        return tracks
+
+    def move_watches(self, playlist, folder, newPlaylist, newFolder) -> None:
+        """Points the watches of a renamed folder (or whole playlist if `folder` is None) at its new name"""
+        for wd, (p, f) in list(self.watches.items()):
+            if p != playlist:
+                continue
+            if folder is None:
+                self.watches[wd] = (newPlaylist, f)
+            elif f == folder or f.startswith(f"{folder}/"):
+                self.watches[wd] = (newPlaylist, newFolder + f[len(folder):])
+
+    def drop_watches(self, playlist, folder) -> None:
+        for wd, (p, f) in list(self.watches.items()):
+            if p == playlist and (f == folder or f.startswith(f"{folder}/")):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                self.watches.pop(wd, None)
+
+    def watch_inotify(self) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.mode = "inotify"
+        self.watches = {}
+        try:
+            self.add_watch(None, "")
+            # the index already knows every folder, no need to walk the disk again
+            for path in self.library.folders():
+                playlist, _, folder = path.partition('/')
+                self.add_watch(playlist, folder)
+            print(f"Watching {len(self.watches)} library folders for changes...")
+            while not self.shouldDie:
+                ready, _, _ = select.select([self.fd], [], [], 1)
+                if ready:
+                    self.read_events(os.read(self.fd, 64 * 1024))
+        finally:
+            os.close(self.fd)
+
+    def read_events(self, data) -> None:
+        moves = {}  # cookie -> (playlist, path, is folder) waiting for its IN_MOVED_TO
+        touched = set()  # playlists whose index entry is now out of date
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                print("inotify queue overflowed, some changes were missed")
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or name.startswith('.'):
+                continue
+            playlist, folder = self.watches[wd]
+            isDir = bool(mask & IN_ISDIR)
+            touched.add(playlist if playlist is not None else name)
+            if playlist is None:
+                # a playlist folder changed
+                if not isDir:
+                    continue
+                if mask & IN_MOVED_FROM:
+                    moves[cookie] = (None, name, True)
+                elif mask & IN_MOVED_TO and cookie in moves:
+                    old = moves.pop(cookie)[1]
+                    self.move_watches(old, None, name, None)
+                    touched.discard(old)
+                    self.emit("rename", old, renamed=name)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(name, "")
+                    self.emit("add", name)
+                elif mask & IN_DELETE:
+                    self.emit("remove", name)
+                continue
+            path = f"{folder}/{name}" if folder else name
+            if mask & IN_MOVED_FROM:
+                moves[cookie] = (playlist, path, isDir)
+            elif mask & IN_MOVED_TO and cookie in moves:
+                source, old, _ = moves.pop(cookie)
+                if not isDir:
+                    if not is_audio(name):
+                        continue
+                    if source == playlist:
+                        self.emit("rename", playlist, old, path)
+                    else:
+                        self.emit("remove", source, old)
+                        self.emit("add", playlist, path)
+                elif source == playlist:
+                    # renamed folder, the tracks inside keep their queue spots
+                    self.move_watches(playlist, old, playlist, path)
+                    for track in self.library_tracks(playlist, old):
+                        self.emit("rename", playlist, track, path + track[len(old):])
+                else:
+                    self.drop_watches(source, old)
+                    for track in self.library_tracks(source, old):
+                        self.emit("remove", source, track)
+                    for track in self.watch_tree(playlist, path):
+                        self.emit("add", playlist, track)
+            elif mask & (IN_CREATE | IN_MOVED_TO) and isDir:
+                for track in self.watch_tree(playlist, path):
+                    self.emit("add", playlist, track)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and not isDir and is_audio(name):
+                # a new file is only complete once the copy closes it
+                self.emit("add", playlist, path)
+            elif mask & IN_DELETE and not isDir and is_audio(name):
+                self.emit("remove", playlist, path)
+        # moved out of the music directory entirely
+        for playlist, path, isDir in moves.values():
+            if playlist is None:
+                self.emit("remove", path)
+            elif isDir:
+                self.drop_watches(playlist, path)
+                for track in self.library_tracks(playlist, path):
+                    self.emit("remove", playlist, track)
+            elif is_audio(path):
+                self.emit("remove", playlist, path)
+        # keep the index in step so later folder moves know what was inside
+        for playlist in touched:
+            if os.path.isdir(f"{self.root}/{playlist}"):
+                self.library.refresh_folder(playlist)
+
+    def library_tracks(self, playlist, folder) -> list:
+        # the folder is already gone from its old spot, so ask the index what was in it
+        return [t for t in self.library.tracks(playlist) if t.startswith(f"{folder}/")]
+
+    # polling backend
+
+    def watch_polling(self) -> None:
+        self.mode = "polling"
+        known = {name for name, _ in self.library.refresh()}
+        while not self.shouldDie:
+            time.sleep(self.interval)
+            changes = []
+            current = {name for name, _ in self.library.refresh(
+                on_changed=lambda *change: changes.append(change))}
+            for name in known - current:
+                self.emit("remove", name)
+            for name, before, after in changes:
+                if name not in known:
+                    self.emit("add", name)
+                    continue
+                before = set(before)
+                after = set(after)
+                for track in sorted(before - after):
+                    self.emit("remove", name, track)
+                for track in sorted(after - before):
+                    self.emit("add", name, track)
+            known = current